@@ -0,0 +1,328 @@
+"""Offline load simulation for the music bot.
+
+Runs the real command handlers and MusicPlayer against fake voice clients,
+contexts and a stubbed yt-dlp, so no Discord connection or network is needed.
+
+    python benchmark.py --guilds 50 --ops 40
+    python benchmark.py --guilds 20 --bulk-guilds 5
+    python benchmark.py --save baseline.json
+    python benchmark.py --baseline baseline.json
+"""
+import argparse
+import asyncio
+import gc
+import json
+import random
+import threading
+import time
+import tracemalloc
+import types
+import zlib
+
+import discord
+import yt_dlp
+
+import music_bot
+
+SILENT_FRAME = b'\0' * 3840
+
+class FakeYoutubeDL:
+    """Stands in for yt_dlp.YoutubeDL, answering every lookup after a fixed delay"""
+    latency = 0.05
+    flat_latency = 0.01
+    calls = 0
+    lock = threading.Lock()
+
+    def __init__(self, options=None):
+        self.options = options or {}
+
+    def extract_info(self, url, download=False, process=True):
+        with FakeYoutubeDL.lock:
+            FakeYoutubeDL.calls += 1
+        # Flat lookups skip format resolution, which is most of the cost
+        time.sleep(self.flat_latency if self.options.get('extract_flat') else self.latency)
+        if url.startswith('ytsearch'):
+            query = url.split(':', 1)[1]
+            return {'entries': [self.track(f"{zlib.crc32(query.encode()):011d}", query)]}
+        video_id = url.rsplit('=', 1)[-1][-11:]
+        return self.track(video_id, video_id)
+
+    def track(self, video_id, title):
+        return {
+            'id': video_id,
+            'title': f"Track {title}",
+            'url': f"https://example.invalid/videoplayback?expire={int(time.time()) + 21600}&id={video_id}",
+            'webpage_url': music_bot.youtube_url(video_id),
+            'duration': FakeAudioSource.frames_per_track * music_bot.FRAME_LENGTH,
+            'thumbnail': None,
+            'uploader': 'Benchmark',
+            'acodec': 'opus',
+        }
+
+    @property
+    def cookiejar(self):
+        return None
+
+    @property
+    def _request_director(self):
+        return None
+
+    def get_info_extractor(self, ie_key):
+        return types.SimpleNamespace()
+
+    def prepare_filename(self, data):
+        return f"{data['id']}.opus"
+
+class FakeAudioSource(music_bot.TrackSource, discord.AudioSource):
+    """Silent local audio, a fixed number of 20ms frames long"""
+    frames_per_track = 50
+
+    def __init__(self, data, *, volume=0.5, start=0, path=None):
+        self.volume = volume
+        self.remaining = self.frames_per_track
+        self.set_track(data, start)
+
+    def read(self):
+        if self.remaining <= 0:
+            return b''
+        self.remaining -= 1
+        self.frames += 1
+        return SILENT_FRAME
+
+    def is_opus(self):
+        return False
+
+class FakeVoiceClient:
+    """Plays sources on a thread and calls after() like discord.VoiceClient"""
+    frame_delay = 0.001
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.source = None
+        self.playing = False
+        self.paused = threading.Event()
+        self.stopped = threading.Event()
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return self.playing and not self.paused.is_set()
+
+    def is_paused(self):
+        return self.playing and self.paused.is_set()
+
+    def play(self, source, *, after=None):
+        self.source = source
+        self.playing = True
+        self.paused.clear()
+        self.stopped = stopped = threading.Event()
+
+        def run():
+            while not stopped.is_set():
+                if self.paused.is_set():
+                    time.sleep(self.frame_delay)
+                    continue
+                if not self.source.read():
+                    break
+                time.sleep(self.frame_delay)
+            self.playing = False
+            self.source.cleanup()
+            if after:
+                after(None)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def pause(self):
+        self.paused.set()
+
+    def resume(self):
+        self.paused.clear()
+
+    def stop(self):
+        self.stopped.set()
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+
+class FakeMessage:
+    async def edit(self, **kwargs):
+        pass
+
+    async def delete(self):
+        pass
+
+class FakeContext:
+    def __init__(self, guild_id):
+        channel = types.SimpleNamespace(id=guild_id, members=[], connect=self.connect)
+        self.guild = types.SimpleNamespace(id=guild_id, voice_client=None)
+        self.channel = types.SimpleNamespace(id=guild_id, send=self.send)
+        self.author = types.SimpleNamespace(
+            id=guild_id, display_name=f"listener-{guild_id}", bot=False,
+            voice=types.SimpleNamespace(channel=channel)
+        )
+        self.interaction = None
+        self.sent = 0
+
+    async def connect(self, **kwargs):
+        return FakeVoiceClient(self.author.voice.channel)
+
+    async def send(self, *args, **kwargs):
+        self.sent += 1
+        return FakeMessage()
+
+    def typing(self, *, ephemeral=False):
+        return FakeTyping()
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+def install_fakes(args):
+    FakeYoutubeDL.latency = args.extract_latency
+    FakeYoutubeDL.flat_latency = args.flat_latency
+    FakeAudioSource.frames_per_track = args.track_frames
+    FakeVoiceClient.frame_delay = args.frame_delay
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+    music_bot.make_source = FakeAudioSource
+    # Keep the run hermetic: nothing written to disk
+    music_bot.audio_cache.max_bytes = 0
+    music_bot.search_index.db_path = None
+    music_bot.state.db_path = None
+    music_bot.library.directory = None
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def simulate_guild(guild_id, args, rng, latencies):
+    ctx = FakeContext(guild_id)
+    if guild_id <= args.bulk_guilds:
+        # A party queue pasted in one go, competing with everyone else's plays
+        started = time.perf_counter()
+        await music_bot.playmany(ctx, queries=';'.join(f"bulk {guild_id} {i}" for i in range(args.bulk_size)))
+        latencies.setdefault('playmany', []).append(time.perf_counter() - started)
+    operations = ['play'] * 6 + ['skip', 'shuffle', 'queue']
+    for _ in range(args.ops):
+        operation = rng.choice(operations)
+        started = time.perf_counter()
+        if operation == 'play':
+            await music_bot.play(ctx, query=f"song {rng.randrange(args.catalog)}")
+        elif operation == 'skip':
+            await music_bot.skip(ctx)
+        elif operation == 'shuffle':
+            await music_bot.shuffle(ctx)
+        else:
+            await music_bot.queue(ctx)
+        latencies.setdefault(operation, []).append(time.perf_counter() - started)
+        await asyncio.sleep(rng.uniform(0, args.think_time))
+
+async def run(args):
+    music_bot.bot.loop = asyncio.get_running_loop()
+    rng = random.Random(args.seed)
+    latencies = {}
+
+    gc.collect()
+    tracemalloc.start()
+    baseline_memory = tracemalloc.get_traced_memory()[0]
+    tracks_before = music_bot.metrics.tracks_started.value
+    started = time.perf_counter()
+
+    await asyncio.gather(*(
+        simulate_guild(guild_id, args, random.Random(rng.random()), latencies)
+        for guild_id in range(1, args.guilds + 1)
+    ))
+    # Let queued tracks play out so transitions are measured under load
+    deadline = time.perf_counter() + args.drain
+    while time.perf_counter() < deadline and any(player.is_playing() for player in music_bot.music_players.values()):
+        await asyncio.sleep(0.05)
+
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    memory = tracemalloc.get_traced_memory()[0] - baseline_memory
+    tracemalloc.stop()
+
+    gaps = [gap for player in music_bot.music_players.values() for gap in player.transition_gaps]
+    transitions = music_bot.metrics.tracks_started.value - tracks_before
+    cache = music_bot.track_cache
+    result = {
+        'guilds': args.guilds,
+        'elapsed_seconds': elapsed,
+        'commands': {
+            name: {
+                'count': len(samples),
+                'p50_ms': percentile(samples, 0.50) * 1000,
+                'p90_ms': percentile(samples, 0.90) * 1000,
+                'p99_ms': percentile(samples, 0.99) * 1000,
+                'max_ms': max(samples) * 1000,
+            }
+            for name, samples in sorted(latencies.items())
+        },
+        'transitions': transitions,
+        'transitions_per_second': transitions / elapsed,
+        'transition_gap_p50_ms': percentile(gaps, 0.50) * 1000 if gaps else None,
+        'transition_gap_p99_ms': percentile(gaps, 0.99) * 1000 if gaps else None,
+        'extractions': FakeYoutubeDL.calls,
+        'track_cache_hit_rate': cache.hits / max(1, cache.hits + cache.misses),
+        'memory_per_guild_bytes': memory / args.guilds,
+    }
+
+    for player in list(music_bot.music_players.values()):
+        await player.shutdown()
+    return result
+
+def report(result, baseline=None):
+    def delta(value, old):
+        if old in (None, 0) or value is None:
+            return ''
+        return f" ({(value - old) / old * 100:+.1f}%)"
+
+    old = baseline or {}
+    print(f"{result['guilds']} guilds in {result['elapsed_seconds']:.2f}s")
+    print(f"{'command':<10}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stats in result['commands'].items():
+        print(f"{name:<10}{stats['count']:>7}{stats['p50_ms']:>10.2f}{stats['p90_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}"
+              f"{delta(stats['p99_ms'], old.get('commands', {}).get(name, {}).get('p99_ms'))}")
+    print(f"transitions/s      {result['transitions_per_second']:.1f}{delta(result['transitions_per_second'], old.get('transitions_per_second'))}")
+    if result['transition_gap_p50_ms'] is not None:
+        print(f"transition gap     p50 {result['transition_gap_p50_ms']:.2f}ms, p99 {result['transition_gap_p99_ms']:.2f}ms"
+              f"{delta(result['transition_gap_p99_ms'], old.get('transition_gap_p99_ms'))}")
+    print(f"extractions        {result['extractions']}{delta(result['extractions'], old.get('extractions'))}")
+    print(f"track cache hits   {result['track_cache_hit_rate'] * 100:.1f}%")
+    print(f"memory per guild   {result['memory_per_guild_bytes'] / 1024:.1f} KB{delta(result['memory_per_guild_bytes'], old.get('memory_per_guild_bytes'))}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=50, help='guilds issuing commands concurrently')
+    parser.add_argument('--ops', type=int, default=30, help='commands issued per guild')
+    parser.add_argument('--bulk-guilds', type=int, default=0, help='guilds that start with a .playmany')
+    parser.add_argument('--bulk-size', type=int, default=30, help='songs in each .playmany')
+    parser.add_argument('--catalog', type=int, default=200, help='distinct songs the guilds pick from')
+    parser.add_argument('--extract-latency', type=float, default=0.05, help='seconds each stubbed extract_info call takes')
+    parser.add_argument('--flat-latency', type=float, default=0.01, help='seconds each stubbed flat search takes')
+    parser.add_argument('--track-frames', type=int, default=50, help='20ms frames in every fake track')
+    parser.add_argument('--frame-delay', type=float, default=0.001, help='seconds the fake voice client waits per frame')
+    parser.add_argument('--think-time', type=float, default=0.02, help='maximum pause between one guild\'s commands')
+    parser.add_argument('--drain', type=float, default=5.0, help='seconds to let queues play out after the last command')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='compare against results saved earlier with --save')
+    args = parser.parse_args()
+
+    install_fakes(args)
+    result = asyncio.run(run(args))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,47 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
+from discord import app_commands
 import asyncio
-import yt_dlp
 import os
-from collections import deque
+from collections import deque, OrderedDict
 import urllib.parse
 import re
+import time
+import random
+import threading
+import concurrent.futures
+import shlex
+import sys
+import sqlite3
+import bisect
+import json
+import signal
+import subprocess
+import urllib.request
+import weakref
+import hashlib
+from aiohttp import web
+
+# Sharding: SHARD_WORKERS > 1 makes this process a supervisor that runs one
+# worker process per shard range, each worker gets SHARD_COUNT and SHARD_IDS
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '1'))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0'))
+SHARD_IDS = [int(shard) for shard in os.getenv('SHARD_IDS', '').split(',') if shard.strip()] or None
+
+# Slash command sync: skipped while the command tree matches the hash saved at the last sync
+COMMAND_HASH_FILE = os.getenv('COMMAND_HASH_FILE', '.command_hash')
+DEV_GUILD_ID = int(os.getenv('DEV_GUILD_ID', '0'))  # sync to this guild only, for development
+commands_synced = False
 
 # Bot setup
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
-bot = commands.Bot(command_prefix='.', intents=intents, help_command=None)
+if SHARD_COUNT or SHARD_IDS:
+    bot = commands.AutoShardedBot(command_prefix='.', intents=intents, help_command=None,
+                                  shard_count=SHARD_COUNT or None, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix='.', intents=intents, help_command=None)
 
 # Custom emojis (using Unicode alternatives)
 EMOJIS = {
@@ -41,6 +71,9 @@ EMOJIS = {
 }
 
 # YouTube-DL options
+COOKIE_FILE = os.getenv('COOKIE_FILE', 'cookies.txt')  # Netscape cookie file used for every extraction, if it exists
+YTDL_CACHE_DIR = os.getenv('YTDL_CACHE_DIR', 'ytdl_cache')
+
 ytdl_format_options = {
     'format': 'bestaudio/best',
     'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
@@ -52,48 +85,1688 @@ ytdl_format_options = {
     'quiet': True,
     'no_warnings': True,
     'default_search': 'auto',
-    'source_address': '0.0.0.0'
+    'source_address': '0.0.0.0',
+    # Player JS and signature functions, kept between restarts
+    'cachedir': YTDL_CACHE_DIR,
+}
+if os.path.isfile(COOKIE_FILE):
+    # Signed-in cookies get past consent pages and most throttling
+    ytdl_format_options['cookiefile'] = COOKIE_FILE
+
+# Playlists are read page by page as flat url entries and resolved later
+ytdl_playlist_options = dict(ytdl_format_options, noplaylist=False, extract_flat='in_playlist')
+
+# Searches only need the ID, title and duration for the queue, formats are resolved before playing
+ytdl_search_options = dict(ytdl_format_options, extract_flat=True)
+
+YTDL_PROFILES = {
+    'default': ytdl_format_options,
+    'playlist': ytdl_playlist_options,
+    'search': ytdl_search_options,
 }
 
+URL_RE = re.compile(r'^https?://\S+$')
+
+PLAYLIST_LIMIT = int(os.getenv('PLAYLIST_LIMIT', '1000'))
+PLAYLIST_TIMEOUT = float(os.getenv('PLAYLIST_TIMEOUT', '300'))
+# Only links to the playlist itself, watch?v=...&list=... links copied from a browser play the one video
+PLAYLIST_RE = re.compile(r'^https?://\S*(?:/playlist\b|/sets/)')
+
+# Bulk enqueue config
+PLAYMANY_LIMIT = int(os.getenv('PLAYMANY_LIMIT', '50'))
+PLAYMANY_CONCURRENCY = int(os.getenv('PLAYMANY_CONCURRENCY', '4'))  # lookups one .playmany runs at a time
+PLAYMANY_SPLIT_RE = re.compile(r'[\n;]+')
+PROGRESS_INTERVAL = 2.0  # seconds between edits of a progress message
+
 ffmpeg_options = {
     'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
     'options': '-vn'
 }
 
-ytdl = yt_dlp.YoutubeDL(ytdl_format_options)
+# 'opus' hands discord.py ready-made Opus packets (codec copy at 100% volume,
+# FFmpeg volume filter otherwise), 'pcm' decodes and scales volume in Python
+PLAYBACK_MODE = os.getenv('PLAYBACK_MODE', 'opus')
+FRAME_LENGTH = 0.02  # every AudioSource.read() returns 20ms of audio
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
-        super().__init__(source, volume)
+def ffmpeg_before_options(start=0, local=False):
+    # Local files need none of the reconnect handling
+    options = '' if local else ffmpeg_options['before_options']
+    if start:
+        return f"-ss {start:.2f} {options}".strip()
+    return options
+
+# On-disk audio cache
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', 'audio_cache')
+AUDIO_CACHE_BYTES = int(os.getenv('AUDIO_CACHE_BYTES', str(512 * 1024 * 1024)))  # 0 disables the cache
+AUDIO_CACHE_MAX_DURATION = int(os.getenv('AUDIO_CACHE_MAX_DURATION', '900'))
+AUDIO_CACHE_FILLS = int(os.getenv('AUDIO_CACHE_FILLS', '2'))
+
+class AudioCache:
+    """Opus files keyed by video ID, evicting the least recently played past a byte budget
+
+    Shard workers can point at the same directory. The directory is the
+    index they share: a miss checks for a file another worker wrote, and
+    every fill re-reads the directory so the budget covers all workers'
+    files, oldest mtime evicted first.
+    """
+    def __init__(self, directory=AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.files = OrderedDict()
+        self.size = 0
+        self.loaded = False
+        self.filling = set()
+        self.tasks = set()
+        self.semaphore = None
+
+    def load(self):
+        self.loaded = True
+        if not self.max_bytes:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.index(self.scan())
+        self.evict()
+
+    def scan(self):
+        """(mtime, video_id, size) of every cached file, least recently played first"""
+        found = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.name.endswith('.part'):
+                        # Left behind by a fill that never finished, other shard
+                        # workers may still be writing recent ones
+                        if time.time() - entry.stat().st_mtime > 3600:
+                            os.remove(entry.path)
+                    elif entry.name.endswith('.opus'):
+                        stat = entry.stat()
+                        found.append((stat.st_mtime, entry.name[:-len('.opus')], stat.st_size))
+                except FileNotFoundError:
+                    pass  # removed by another worker while we looked
+        return sorted(found)
+
+    def index(self, found):
+        self.files = OrderedDict((video_id, size) for _, video_id, size in found)
+        self.size = sum(self.files.values())
+
+    def path(self, video_id):
+        return os.path.join(self.directory, f"{video_id}.opus")
+
+    def get(self, video_id):
+        if not self.loaded:
+            self.load()
+        # Only names fill() would have written, anything else is never cached
+        if not self.max_bytes or not video_id or not re.fullmatch(r'[\w-]+', video_id):
+            return None
+        path = self.path(video_id)
+        try:
+            # The mtime keeps the LRU order across restarts and shard workers
+            os.utime(path)
+        except FileNotFoundError:
+            self.size -= self.files.pop(video_id, 0)
+            return None
+        if video_id not in self.files:
+            # Filled by another shard worker since we last looked
+            self.files[video_id] = os.path.getsize(path)
+            self.size += self.files[video_id]
+        self.files.move_to_end(video_id)
+        return path
+
+    def wants(self, data):
+        if not self.loaded:
+            self.load()
+        video_id = data.get('id')
+        return bool(
+            self.max_bytes and video_id and data.get('url')
+            and re.fullmatch(r'[\w-]+', video_id)
+            and video_id not in self.files and video_id not in self.filling
+            and not os.path.exists(self.path(video_id))
+            and data.get('duration') and data['duration'] <= AUDIO_CACHE_MAX_DURATION
+        )
+
+    def schedule(self, data):
+        self.filling.add(data['id'])
+        task = asyncio.get_event_loop().create_task(self.fill(data))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def fill(self, data):
+        video_id = data['id']
+        path = self.path(video_id)
+        part = f"{path}.{os.getpid()}.part"
+        codec = ('-c:a', 'copy') if data.get('acodec') == 'opus' else ('-c:a', 'libopus', '-b:a', '128k')
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(AUDIO_CACHE_FILLS)
+        try:
+            async with self.semaphore:
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-nostdin', '-loglevel', 'error', '-y',
+                    *shlex.split(ffmpeg_options['before_options']), '-i', data['url'],
+                    '-vn', '-map_metadata', '-1', *codec, '-f', 'opus', part,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+                if await process.wait() != 0:
+                    raise RuntimeError(f"ffmpeg exited with {process.returncode}")
+            # Readers only ever see complete files
+            os.replace(part, path)
+        except Exception as e:
+            print(f"Audio cache fill failed for {video_id}: {e}")
+            if os.path.exists(part):
+                os.remove(part)
+            return
+        finally:
+            self.filling.discard(video_id)
+
+        # Other workers fill and evict the same directory, so count from what is on disk
+        self.index(await asyncio.to_thread(self.scan))
+        self.evict()
+
+    def evict(self):
+        while self.size > self.max_bytes and self.files:
+            video_id, size = self.files.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.path(video_id))
+            except FileNotFoundError:
+                pass
+
+audio_cache = AudioCache()
+
+# Metrics
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # 0 disables the endpoint, shard workers add their first shard ID
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+LOOP_LAG_INTERVAL = 0.5
+
+class Histogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help, label=None, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.series = {}
+        # Observed from extraction and voice threads as well as the event loop
+        self.lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        with self.lock:
+            counts = self.series.setdefault(label_value, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {key: list(counts) for key, counts in self.series.items()}
+        for label_value, counts in series.items():
+            prefix = f'{self.label}="{label_value}",' if self.label else ''
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {counts[-2]}')
+            labels = f'{{{prefix[:-1]}}}' if prefix else ''
+            lines.append(f"{self.name}_count{labels} {counts[-2]}")
+            lines.append(f"{self.name}_sum{labels} {counts[-1]}")
+        return lines
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+class Gauge:
+    """Read on every scrape, fn returns a number or a {label value: number} dict"""
+    def __init__(self, name, help, fn, label=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label = label
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        value = self.fn()
+        if isinstance(value, dict):
+            lines.extend(f'{self.name}{{{self.label}="{key}"}} {item}' for key, item in value.items())
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+class Metrics:
+    def __init__(self):
+        self.extract_seconds = Histogram('muse_extract_seconds', 'Time spent in yt-dlp per extraction job', label='profile')
+        self.extract_wait_seconds = Histogram('muse_extract_wait_seconds', 'Time extraction jobs waited for a worker', label='priority')
+        self.extract_errors = Counter('muse_extract_errors_total', 'Extraction jobs that raised')
+        self.first_audio_seconds = Histogram('muse_time_to_first_audio_seconds', 'Time from a play command until voice playback starts')
+        self.transition_gap_seconds = Histogram('muse_transition_gap_seconds', 'Silence between one track ending and the next starting')
+        self.loop_lag_seconds = Histogram('muse_event_loop_lag_seconds', 'How late the event loop woke a sleeping task')
+        self.tracks_started = Counter('muse_tracks_started_total', 'Tracks handed to a voice client')
+        self.extract_shared = Counter('muse_extract_shared_total', 'Extractions answered by joining an identical one already running')
+        self.messages_sent = Counter('muse_messages_sent_total', 'Messages sent or edited through the message bus')
+        self.messages_dropped = Counter('muse_messages_dropped_total', 'Messages dropped for going stale while rate limited')
+        self.metrics = [self.extract_seconds, self.extract_wait_seconds, self.extract_errors, self.first_audio_seconds,
+                        self.transition_gap_seconds, self.loop_lag_seconds, self.tracks_started, self.extract_shared,
+                        self.messages_sent, self.messages_dropped]
+        self.server = None
+        self.lag_task = None
+
+    def add_gauge(self, name, help, fn, label=None):
+        self.metrics.append(Gauge(name, help, fn, label))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    async def handle(self, request):
+        return web.Response(text=self.render(), content_type='text/plain', charset='utf-8')
+
+    async def start(self, port, host=METRICS_HOST):
+        if self.lag_task is None:
+            self.lag_task = asyncio.get_running_loop().create_task(self.watch_loop_lag())
+        if not port or self.server is not None:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self.server = web.AppRunner(app, access_log=None)
+        await self.server.setup()
+        await web.TCPSite(self.server, host, port).start()
+        print(f'{EMOJIS["info"]} Serving metrics on http://{host}:{port}/metrics')
+
+    async def watch_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            before = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.loop_lag_seconds.observe(max(0.0, loop.time() - before - LOOP_LAG_INTERVAL))
+
+metrics = Metrics()
+
+# Extraction engine
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', '4'))
+EXTRACT_QUEUE_SIZE = int(os.getenv('EXTRACT_QUEUE_SIZE', '32'))
+EXTRACT_TIMEOUT = float(os.getenv('EXTRACT_TIMEOUT', '30'))
+
+class ExtractionError(Exception):
+    pass
+
+# Extraction priorities, lower runs first. Within a priority guilds take turns.
+PRIORITY_NOW = 0  # audio someone is waiting to hear: the next track, a play that starts playback
+PRIORITY_NORMAL = 1  # a single .play that only queues
+PRIORITY_BULK = 2  # prefetches, playlists, .playmany, stream refreshes
+PRIORITY_NAMES = ('now', 'normal', 'bulk')
+
+class Job:
+    __slots__ = ('future', 'fn', 'profile', 'guild_id', 'priority', 'queued_at', 'started_at')
+
+    def __init__(self, fn, profile, guild_id, priority):
+        self.future = concurrent.futures.Future()
+        self.fn = fn
+        self.profile = profile
+        self.guild_id = guild_id
+        self.priority = priority
+        self.queued_at = time.perf_counter()
+        self.started_at = None  # set by the worker that picks it up
+
+class Flight:
+    """One extraction shared by every caller that asked for the same track while it ran"""
+    __slots__ = ('job', 'task', 'guilds')
+
+    def __init__(self, job, task):
+        self.job = job
+        self.task = task
+        self.guilds = {}
+
+    def join(self, guild_id):
+        self.guilds[guild_id] = self.guilds.get(guild_id, 0) + 1
+
+    def leave(self, guild_id):
+        """Stop waiting, returning True if that cancelled the lookup"""
+        count = self.guilds.pop(guild_id, 0) - 1
+        if count > 0:
+            self.guilds[guild_id] = count
+        # Nobody is left waiting, stop the lookup
+        if not self.guilds and not self.task.done():
+            self.task.cancel()
+            return True
+        return False
+
+class ExtractionEngine:
+    """Worker threads that each own a YoutubeDL, fed fairly from per-guild job queues
+
+    Jobs wait in one deque per guild for each priority. Workers always serve
+    the most urgent priority that has work, and within it take one job from
+    each guild in turn, so a guild queueing fifty songs cannot hold up
+    another guild's next track.
+    """
+    def __init__(self, workers=EXTRACT_WORKERS, queue_size=EXTRACT_QUEUE_SIZE, timeout=EXTRACT_TIMEOUT):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.levels = [OrderedDict() for _ in PRIORITY_NAMES]  # guild_id -> deque of jobs, in turn order
+        self.counts = [0] * len(PRIORITY_NAMES)
+        self.ready = threading.Condition()
+        self.threads = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pending = {}
+        # Extractions in progress by track key, see extract()
+        self.flights = {}
+        # Shared by every worker's YoutubeDL, see share()
+        self.cookiejar = None
+        self.code_cache = {}
+        self.player_cache = {}
+
+    @property
+    def depth(self):
+        return sum(self.counts)
+
+    def start(self):
+        for i in range(self.workers - len(self.threads)):
+            thread = threading.Thread(target=self.work, name=f"extractor-{len(self.threads)}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def ytdl(self, profile='default'):
+        # YoutubeDL is not thread safe, so every worker builds its own
+        instances = self.local.__dict__.setdefault('ytdl', {})
+        ytdl = instances.get(profile)
+        if ytdl is None:
+            # Imported here so startup doesn't wait on yt-dlp and its extractors
+            import yt_dlp
+            ytdl = instances[profile] = yt_dlp.YoutubeDL(YTDL_PROFILES[profile])
+            self.share(ytdl)
+        return ytdl
+
+    def share(self, ytdl):
+        """Point a new YoutubeDL at the state worth reusing between extractions
+
+        The cookie jar is read from disk once and shared by every worker
+        (it locks itself). Each worker's profiles also share one request
+        director, so they reuse its pooled keep-alive connections, and the
+        YouTube extractors all share the downloaded player JS and the
+        signature functions solved from it.
+        """
+        with self.lock:
+            if self.cookiejar is None:
+                self.cookiejar = ytdl.cookiejar
+        ytdl.__dict__['cookiejar'] = self.cookiejar
+        director = getattr(self.local, 'director', None)
+        if director is None:
+            # Sessions are not thread safe, so pooling stops at the worker
+            self.local.director = ytdl._request_director
+        else:
+            ytdl.__dict__['_request_director'] = director
+        youtube = ytdl.get_info_extractor('Youtube')
+        if hasattr(youtube, '_player_cache'):
+            youtube._code_cache = self.code_cache
+            youtube._player_cache = self.player_cache
+
+    def submit(self, fn, *, guild_id=None, profile='default', priority=PRIORITY_NORMAL):
+        if not self.threads:
+            self.start()
+        job = Job(fn, profile, guild_id, priority)
+        with self.ready:
+            # Each priority has its own limit so bulk work can't lock out plays,
+            # and work someone is waiting to hear is never turned away
+            if priority != PRIORITY_NOW and self.counts[priority] >= self.queue_size:
+                raise ExtractionError(f"The bot is busy ({self.counts[priority]} searches waiting), try again in a moment")
+            self.levels[priority].setdefault(guild_id, deque()).append(job)
+            self.counts[priority] += 1
+            self.ready.notify()
+        return job
+
+    def take(self):
+        """Block until a job is queued and return the next one due"""
+        with self.ready:
+            while not any(self.levels):
+                self.ready.wait()
+            for priority, level in enumerate(self.levels):
+                if not level:
+                    continue
+                guild_id, jobs = next(iter(level.items()))
+                job = jobs.popleft()
+                if jobs:
+                    level.move_to_end(guild_id)
+                else:
+                    del level[guild_id]
+                self.counts[priority] -= 1
+                return job
+
+    def promote(self, job, priority):
+        """Move a queued job up to a more urgent priority"""
+        with self.ready:
+            if priority >= job.priority:
+                return
+            jobs = self.levels[job.priority].get(job.guild_id)
+            if not jobs or job not in jobs:
+                return  # already running
+            jobs.remove(job)
+            if not jobs:
+                del self.levels[job.priority][job.guild_id]
+            self.counts[job.priority] -= 1
+            job.priority = priority
+            self.levels[priority].setdefault(job.guild_id, deque()).append(job)
+            self.counts[priority] += 1
+
+    def work(self):
+        # Build the YoutubeDL up front, off the event loop, so the first search doesn't pay for it
+        try:
+            self.ytdl()
+        except Exception as e:
+            print(f"Extractor warm-up failed: {e}")
+        while True:
+            job = self.take()
+            # Jobs cancelled while queued are skipped without touching yt-dlp
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            started = job.started_at = time.perf_counter()
+            metrics.extract_wait_seconds.observe(started - job.queued_at, PRIORITY_NAMES[job.priority])
+            try:
+                result = job.fn(self.ytdl(job.profile))
+            except BaseException as e:
+                metrics.extract_errors.inc()
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+            finally:
+                metrics.extract_seconds.observe(time.perf_counter() - started, job.profile)
+
+    async def wait(self, job, *, guild_id=None, timeout=None):
+        with self.lock:
+            self.pending.setdefault(guild_id, set()).add(job.future)
+        timeout = timeout or self.timeout
+        future = asyncio.wrap_future(job.future)
+        try:
+            # The timeout only counts from when a worker starts the job, bulk
+            # jobs can queue behind plays for longer than one lookup may take
+            while True:
+                started = job.started_at
+                remaining = timeout if started is None else started + timeout - time.perf_counter()
+                if remaining <= 0:
+                    raise ExtractionError("Timed out while looking up the song")
+                done, _ = await asyncio.wait((future,), timeout=remaining)
+                if done:
+                    return future.result()
+        finally:
+            if not future.done():
+                future.cancel()
+            with self.lock:
+                waiting = self.pending.get(guild_id)
+                waiting.discard(job.future)
+                if not waiting:
+                    del self.pending[guild_id]
+
+    async def run(self, fn, *, guild_id=None, timeout=None, profile='default', priority=PRIORITY_NORMAL):
+        """Run fn(ytdl) on a worker and wait for its result"""
+        job = self.submit(fn, guild_id=guild_id, profile=profile, priority=priority)
+        return await self.wait(job, guild_id=guild_id, timeout=timeout)
+
+    async def extract(self, url, *, guild_id=None, download=False, key=None, profile='default', priority=PRIORITY_NORMAL):
+        """Extract url, sharing a single job between everyone asking for the same key at once
+
+        key defaults to the URL; callers pass a video ID or normalized search so
+        that different spellings of the same track coalesce too. The job keeps
+        running while anyone still waits on it and errors reach every waiter.
+        A shared job runs at the most urgent priority any of its waiters asked for.
+        """
+        key = (key or url, download, profile)
+        flight = self.flights.get(key)
+        if flight is None:
+            # Queued on the first requester's turn, but cancelled through the flight
+            job = self.submit(lambda ytdl: ytdl.extract_info(url, download=download),
+                              guild_id=guild_id, profile=profile, priority=priority)
+            task = asyncio.ensure_future(self.wait(job))
+            flight = self.flights[key] = Flight(job, task)
+            task.add_done_callback(lambda task, flight=flight: self.land(key, flight))
+        else:
+            metrics.extract_shared.inc()
+            self.promote(flight.job, priority)
+        flight.join(guild_id)
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            if flight.leave(guild_id):
+                # Unlisted at once, the task takes a tick or two to finish
+                # cancelling and nobody new may join it meanwhile
+                self.land(key, flight)
+
+    def land(self, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def cancel_guild(self, guild_id):
+        """Cancel every job a guild is still waiting on, and shared ones only it waits on"""
+        with self.lock:
+            futures = list(self.pending.get(guild_id, ()))
+        for future in futures:
+            future.cancel()
+        for key, flight in list(self.flights.items()):
+            if flight.guilds.pop(guild_id, None) and not flight.guilds:
+                self.land(key, flight)
+                flight.task.cancel()
+                flight.job.future.cancel()
+                futures.append(flight.job.future)
+        # Drop the cancelled jobs now rather than letting them hold queue slots
+        with self.ready:
+            for priority, level in enumerate(self.levels):
+                jobs = level.get(guild_id)
+                if jobs is None:
+                    continue
+                live = deque(job for job in jobs if not job.future.cancelled())
+                self.counts[priority] -= len(jobs) - len(live)
+                if live:
+                    level[guild_id] = live
+                else:
+                    del level[guild_id]
+        return len(futures)
+
+extractor = ExtractionEngine()
+
+# Track resolution cache
+TRACK_CACHE_SIZE = int(os.getenv('TRACK_CACHE_SIZE', '512'))
+TRACK_CACHE_TTL = int(os.getenv('TRACK_CACHE_TTL', '3600'))  # used when a stream URL carries no expiry
+STREAM_EXPIRY_MARGIN = 120  # stop handing out stream URLs this many seconds before they expire
+PREFETCH_LEAD = int(os.getenv('PREFETCH_LEAD', '15'))  # start the next FFmpeg this many seconds before the current track ends
+REFRESH_LEAD = int(os.getenv('REFRESH_LEAD', '900'))  # re-resolve queued songs this many seconds before their stream URLs expire
+REFRESH_CONCURRENCY = int(os.getenv('REFRESH_CONCURRENCY', '2'))  # songs one player re-resolves at a time
+REFRESH_RETRY = 30  # seconds before a failed refresh is tried again, doubling with each failure
+
+# Only the fields the player uses are kept, full info dicts carry every format
+TRACK_FIELDS = ('id', 'url', 'title', 'duration', 'thumbnail', 'uploader', 'webpage_url', 'acodec')
+
+YOUTUBE_ID_RE = re.compile(r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/)|youtu\.be/)([\w-]{11})')
+
+def youtube_url(video_id):
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+def flat_info(entry):
+    """Track info from a flat search or playlist entry, with no stream URL until it is resolved"""
+    thumbnails = entry.get('thumbnails') or ()
+    return {
+        'id': entry['id'],
+        'url': None,
+        'title': entry.get('title') or entry['id'],
+        'duration': entry.get('duration'),
+        'thumbnail': entry.get('thumbnail') or (thumbnails[-1].get('url') if thumbnails else None),
+        'uploader': entry.get('uploader') or entry.get('channel'),
+        'webpage_url': entry.get('webpage_url') or entry.get('url') or youtube_url(entry['id']),
+        'acodec': None,
+    }
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+def stream_expiry(url):
+    """Return the unix time a signed stream URL stops working, if it says so"""
+    if not url:
+        return None
+    parsed = urllib.parse.urlparse(url)
+    expire = urllib.parse.parse_qs(parsed.query).get('expire')
+    if expire:
+        value = expire[0]
+    else:
+        match = re.search(r'/expire/(\d+)', parsed.path)
+        if not match:
+            return None
+        value = match.group(1)
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+def parse_timestamp(text):
+    """Seconds in a timestamp like 83, 1:23 or 1:02:03"""
+    parts = text.strip().split(':')
+    if len(parts) > 3 or not all(part.isdigit() for part in parts):
+        raise ValueError(f"Not a timestamp: {text}")
+    seconds = 0
+    for part in parts:
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+def format_timestamp(seconds):
+    mins, secs = divmod(int(seconds), 60)
+    hours, mins = divmod(mins, 60)
+    if hours:
+        return f"{hours}:{mins:02d}:{secs:02d}"
+    return f"{mins:02d}:{secs:02d}"
+
+class TrackCache:
+    """LRU of resolved tracks keyed by video ID, plus a query -> video ID index"""
+    def __init__(self, maxsize=TRACK_CACHE_SIZE, ttl=TRACK_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.tracks = OrderedDict()
+        self.queries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def video_id(self, query):
+        match = YOUTUBE_ID_RE.search(query)
+        if match:
+            return match.group(1)
+        key = normalize_query(query)
+        video_id = self.queries.get(key)
+        if video_id is not None:
+            self.queries.move_to_end(key)
+        return video_id
+
+    def get(self, video_id, full=False):
+        """Cached info for video_id; full=True skips entries from flat searches that have no stream URL"""
+        entry = self.tracks.get(video_id)
+        if entry is not None:
+            expires_at, info = entry
+            if full and not info['url']:
+                self.misses += 1
+                return None
+            if expires_at > time.time():
+                self.tracks.move_to_end(video_id)
+                self.hits += 1
+                return info
+            del self.tracks[video_id]
+        self.misses += 1
+        return None
+
+    def lookup(self, query, full=False):
+        video_id = self.video_id(query)
+        if video_id is None:
+            self.misses += 1
+            return None
+        return self.get(video_id, full)
+
+    def put(self, data, query=None):
+        info = {field: data.get(field) for field in TRACK_FIELDS}
+        video_id = info['id']
+        if not video_id:
+            return info
+
+        current = self.tracks.get(video_id)
+        if not info['url'] and current is not None and current[1]['url'] and current[0] > time.time():
+            # Keep the fully resolved entry rather than a flat one for the same track
+            info = current[1]
+        else:
+            expires_at = stream_expiry(info['url']) or time.time() + self.ttl
+            self.tracks[video_id] = (expires_at - STREAM_EXPIRY_MARGIN, info)
+        self.tracks.move_to_end(video_id)
+        while len(self.tracks) > self.maxsize:
+            self.tracks.popitem(last=False)
+
+        if query:
+            key = normalize_query(query)
+            self.queries[key] = video_id
+            self.queries.move_to_end(key)
+            while len(self.queries) > self.maxsize * 4:
+                self.queries.popitem(last=False)
+        return info
+
+track_cache = TrackCache()
+
+# Search index for /play autocomplete
+SEARCH_INDEX_SIZE = int(os.getenv('SEARCH_INDEX_SIZE', '5000'))
+SEARCH_INDEX_DB = os.getenv('SEARCH_INDEX_DB')  # optional SQLite file to keep suggestions across restarts
+
+class SearchIndex:
+    """Prefix index over recent searches and track titles, answered without yt-dlp
+
+    Every title is indexed from each word onwards, so typing any word of it
+    (or the start of an earlier search for it) finds the track.
+    """
+    def __init__(self, maxsize=SEARCH_INDEX_SIZE, db_path=SEARCH_INDEX_DB):
+        self.maxsize = maxsize
+        self.db_path = db_path
+        self.db = None
+        self.loaded = False
+        self.tracks = OrderedDict()
+        self.keys = []
+        self.seq = 0
+
+    def load(self):
+        self.loaded = True
+        if not self.db_path:
+            return
+        self.db = sqlite3.connect(self.db_path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS searches (video_id TEXT PRIMARY KEY, url TEXT, title TEXT, query TEXT, used REAL)')
+        self.db.execute('DELETE FROM searches WHERE video_id NOT IN (SELECT video_id FROM searches ORDER BY used DESC LIMIT ?)', (self.maxsize,))
+        self.db.commit()
+        rows = self.db.execute('SELECT video_id, url, title, query FROM searches ORDER BY used DESC').fetchall()
+        for video_id, url, title, query in reversed(rows):
+            self.insert(video_id, url, title, query)
+
+    def index_keys(self, title, query):
+        words = normalize_query(title).split()
+        keys = {' '.join(words[i:]) for i in range(len(words))}
+        if query and not query.startswith(('http://', 'https://')):
+            keys.add(normalize_query(query))
+        return keys
+
+    def insert(self, video_id, url, title, query=None):
+        old = self.tracks.pop(video_id, None)
+        keys = self.index_keys(title, query)
+        if old:
+            keys |= old[2]
+            for key in old[2]:
+                self.discard_key(key, video_id)
+        for key in keys:
+            bisect.insort(self.keys, (key, video_id))
+        self.seq += 1
+        self.tracks[video_id] = (url, title, keys, self.seq)
+        while len(self.tracks) > self.maxsize:
+            evicted, (_, _, evicted_keys, _) = self.tracks.popitem(last=False)
+            for key in evicted_keys:
+                self.discard_key(key, evicted)
+
+    def discard_key(self, key, video_id):
+        i = bisect.bisect_left(self.keys, (key, video_id))
+        if i < len(self.keys) and self.keys[i] == (key, video_id):
+            del self.keys[i]
+
+    def add(self, data, query=None):
+        if not self.loaded:
+            self.load()
+        video_id, url, title = data.get('id'), data.get('webpage_url'), data.get('title')
+        if not (video_id and url and title) or len(url) > 100:
+            return
+        self.insert(video_id, url, title, query)
+        if self.db:
+            self.db.execute('INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?, ?)', (video_id, url, title, query, time.time()))
+            self.db.commit()
+
+    def suggest(self, text, limit=25):
+        """Most recently used (url, title) pairs matching what the user has typed so far"""
+        if not self.loaded:
+            self.load()
+        prefix = normalize_query(text)
+        if not prefix:
+            matches = list(self.tracks)[-limit:]
+        else:
+            matches = set()
+            i = bisect.bisect_left(self.keys, (prefix,))
+            while i < len(self.keys) and self.keys[i][0].startswith(prefix) and len(matches) < limit * 4:
+                matches.add(self.keys[i][1])
+                i += 1
+        ranked = sorted(matches, key=lambda video_id: self.tracks[video_id][3], reverse=True)[:limit]
+        return [self.tracks[video_id][:2] for video_id in ranked]
+
+search_index = SearchIndex()
+
+# Local music library
+LIBRARY_DIR = os.getenv('LIBRARY_DIR')  # directory tree of audio files to serve before searching YouTube
+LIBRARY_DB = os.getenv('LIBRARY_DB', 'library.db')  # SQLite file holding the library's tags and search index
+LIBRARY_SCAN_INTERVAL = int(os.getenv('LIBRARY_SCAN_INTERVAL', '600'))  # seconds between rescans for new or changed files
+LIBRARY_EXTENSIONS = ('.mp3', '.flac', '.ogg', '.opus', '.m4a', '.aac', '.wav', '.wma', '.webm', '.mka')
+LOCAL_PREFIX = 'local:'
+
+def is_local(data):
+    return str(data.get('id') or '').startswith(LOCAL_PREFIX)
+
+def is_live(data):
+    # Live streams report no duration, local files may just be missing the tag
+    return not data.get('duration') and not is_local(data)
+
+def probe_tags(path):
+    """Title, artist, album, duration and codec of an audio file, from ffprobe or failing that the file name"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', '-select_streams', 'a:0', path],
+            capture_output=True, timeout=30, check=True)
+        probed = json.loads(result.stdout)
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return name, None, None, None, None
+    fmt = probed.get('format') or {}
+    stream = (probed.get('streams') or [{}])[0]
+    # Tag names vary in case between containers, and Ogg keeps them on the stream
+    tags = {key.lower(): value for key, value in {**(stream.get('tags') or {}), **(fmt.get('tags') or {})}.items()}
+    try:
+        duration = float(fmt.get('duration') or stream.get('duration'))
+    except (TypeError, ValueError):
+        duration = None
+    return tags.get('title') or name, tags.get('artist') or tags.get('album_artist'), tags.get('album'), duration, stream.get('codec_name')
+
+class LocalLibrary:
+    """Audio files under LIBRARY_DIR, tagged and full-text indexed in SQLite
+
+    Scans are incremental: only files whose mtime or size changed since the
+    last scan are probed again, and files that disappeared are dropped.
+    Searches never touch the network and hits play straight from disk.
+    """
+    def __init__(self, directory=LIBRARY_DIR, db_path=LIBRARY_DB):
+        self.directory = directory
+        self.db_path = db_path
+        self.db = None
+        self.scanning = False
+
+    @property
+    def enabled(self):
+        return bool(self.directory and self.db_path)
+
+    def connect(self):
+        db = sqlite3.connect(self.db_path)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('''CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL, size INTEGER,
+            title TEXT, artist TEXT, album TEXT, duration REAL, codec TEXT)''')
+        db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(title, artist, album, name)')
+        db.commit()
+        return db
+
+    def open(self):
+        if self.db is None and self.enabled:
+            self.db = self.connect()
+        return self.db
+
+    def scan(self):
+        """Bring the index up to date with the directory, returns (added or changed, removed)"""
+        # Runs in a worker thread, so it gets a connection of its own
+        db = self.connect()
+        try:
+            known = {path: (file_id, mtime, size) for file_id, path, mtime, size in db.execute('SELECT id, path, mtime, size FROM files')}
+            seen = set()
+            changed = 0
+            for root, _, names in os.walk(self.directory):
+                for name in names:
+                    if not name.lower().endswith(LIBRARY_EXTENSIONS):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    seen.add(path)
+                    old = known.get(path)
+                    if old and old[1] == stat.st_mtime and old[2] == stat.st_size:
+                        continue
+                    title, artist, album, duration, codec = probe_tags(path)
+                    with db:
+                        if old:
+                            db.execute('UPDATE files SET mtime = ?, size = ?, title = ?, artist = ?, album = ?, duration = ?, codec = ? WHERE id = ?',
+                                       (stat.st_mtime, stat.st_size, title, artist, album, duration, codec, old[0]))
+                            file_id = old[0]
+                            db.execute('DELETE FROM files_fts WHERE rowid = ?', (file_id,))
+                        else:
+                            file_id = db.execute('INSERT INTO files (path, mtime, size, title, artist, album, duration, codec) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                                 (path, stat.st_mtime, stat.st_size, title, artist, album, duration, codec)).lastrowid
+                        db.execute('INSERT INTO files_fts (rowid, title, artist, album, name) VALUES (?, ?, ?, ?, ?)',
+                                   (file_id, title, artist, album, os.path.splitext(name)[0]))
+                    changed += 1
+            removed = [(file_id,) for path, (file_id, _, _) in known.items() if path not in seen]
+            with db:
+                db.executemany('DELETE FROM files WHERE id = ?', removed)
+                db.executemany('DELETE FROM files_fts WHERE rowid = ?', removed)
+            return changed, len(removed)
+        finally:
+            db.close()
+
+    def info(self, row):
+        file_id, path, title, artist, album, duration, codec = row
+        return {
+            'id': f"{LOCAL_PREFIX}{file_id}",
+            'url': path,
+            'webpage_url': None,
+            'title': f"{artist} - {title}" if artist else title,
+            'duration': duration,
+            'thumbnail': None,
+            'uploader': artist or album or 'Local library',
+            'acodec': codec,
+        }
+
+    def matches(self, query, limit=1):
+        """Best matching files for a text query"""
+        db = self.open()
+        words = re.findall(r'\w+', query.lower())
+        if db is None or not words:
+            return []
+        # Every word has to match somewhere, the last one as a prefix
+        match = ' '.join(f'"{word}"' for word in words[:-1]) + f' "{words[-1]}"*'
+        rows = db.execute('''SELECT files.id, path, files.title, files.artist, files.album, duration, codec
+                             FROM files_fts JOIN files ON files.id = files_fts.rowid
+                             WHERE files_fts MATCH ? ORDER BY rank LIMIT ?''', (match.strip(), limit)).fetchall()
+        return [self.info(row) for row in rows]
+
+    def search(self, query):
+        found = self.matches(query)
+        return found[0] if found else None
+
+    def get(self, track_id):
+        db = self.open()
+        if db is None or not str(track_id).startswith(LOCAL_PREFIX):
+            return None
+        row = db.execute('SELECT id, path, title, artist, album, duration, codec FROM files WHERE id = ?',
+                         (track_id[len(LOCAL_PREFIX):],)).fetchone()
+        return self.info(row) if row else None
+
+    def count(self):
+        db = self.open()
+        return db.execute('SELECT COUNT(*) FROM files').fetchone()[0] if db else 0
+
+library = LocalLibrary()
+
+async def resolve_track(query, *, guild_id=None, full=False, priority=PRIORITY_NORMAL):
+    """Resolve a search query or URL to track info, only calling yt-dlp on a cache miss
+
+    Links are extracted directly. Text searches run flat and return info
+    without a stream URL, which MusicPlayer.resolve fills in before playing,
+    unless full is set because the track is about to play anyway.
+    Text searches that match a file in the local library play that instead.
+    """
+    if library.enabled and not URL_RE.match(query):
+        info = library.get(query) or library.search(query)
+        if info is not None:
+            return info
+
+    info = track_cache.lookup(query, full)
+    if info is not None:
+        return info
+
+    video_id = track_cache.video_id(query)
+    if video_id:
+        data = await extractor.extract(youtube_url(video_id), guild_id=guild_id, key=video_id, priority=priority)
+    elif URL_RE.match(query):
+        data = await extractor.extract(query, guild_id=guild_id, priority=priority)
+    elif full:
+        data = await extractor.extract(f"ytsearch1:{query}", guild_id=guild_id, key=f"ytsearch1:{normalize_query(query)}", priority=priority)
+    else:
+        data = await extractor.extract(f"ytsearch1:{query}", guild_id=guild_id, key=f"ytsearch1:{normalize_query(query)}",
+                                       profile='search', priority=priority)
+        if not data.get('entries'):
+            return None
+        return track_cache.put(flat_info(data['entries'][0]), query)
+
+    if 'entries' in data:
+        if not data['entries']:
+            return None
+        data = data['entries'][0]
+    return track_cache.put(data, query)
+
+# Every source we built that has not been garbage collected, for the FFmpeg gauge
+live_sources = weakref.WeakSet()
+
+class TrackSource:
+    """Track metadata and playback position shared by both playback paths"""
+    def set_track(self, data, start=0):
+        live_sources.add(self)
         self.data = data
         self.title = data.get('title')
         self.url = data.get('url')
         self.duration = data.get('duration')
         self.thumbnail = data.get('thumbnail')
         self.uploader = data.get('uploader')
+        self.start = start
+        self.frames = 0
+
+    @property
+    def position(self):
+        return self.start + self.frames * FRAME_LENGTH
+
+    def ffmpeg_running(self):
+        process = getattr(self, '_process', None) or getattr(getattr(self, 'original', None), '_process', None)
+        return process is not None and process.poll() is None
+
+    def read(self):
+        self.frames += 1
+        return super().read()
+
+def stream_playlist(ytdl, url, emit, stop):
+    """Walk a playlist's entries as yt-dlp pages through them, handing each to emit"""
+    info = ytdl.extract_info(url, download=False, process=False)
+    # Some playlist links first redirect to the playlist itself
+    for _ in range(3):
+        if info.get('_type') not in ('url', 'url_transparent'):
+            break
+        info = ytdl.extract_info(info['url'], download=False, process=False)
+
+    count = 0
+    for entry in info.get('entries') or ():
+        if stop.is_set() or count >= PLAYLIST_LIMIT:
+            break
+        if not entry or not entry.get('id') or entry.get('title') in ('[Private video]', '[Deleted video]'):
+            continue
+        emit(entry)
+        count += 1
+    return info.get('title'), count
+
+class YTDLSource(TrackSource, discord.PCMVolumeTransformer):
+    def __init__(self, source, *, data, volume=0.5, start=0):
+        super().__init__(source, volume)
+        self.set_track(data, start)
+
+    @classmethod
+    async def resolve(cls, url, *, guild_id=None, priority=PRIORITY_NORMAL):
+        data = track_cache.lookup(url, full=True)
+        if data is None:
+            data = await extractor.extract(url, guild_id=guild_id, key=track_cache.video_id(url), priority=priority)
+            if 'entries' in data:
+                data = data['entries'][0]
+            data = track_cache.put(data, url)
+        return data
+
+    @classmethod
+    def from_data(cls, data, *, volume=0.5, start=0, path=None):
+        before_options = ffmpeg_before_options(start, local=path is not None)
+        source = discord.FFmpegPCMAudio(path or data['url'], before_options=before_options, options=ffmpeg_options['options'])
+        return cls(source, data=data, volume=volume, start=start)
 
     @classmethod
     async def from_url(cls, url, *, loop=None, stream=False):
-        loop = loop or asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
-        
-        if 'entries' in data:
-            data = data['entries'][0]
-        
-        filename = data['url'] if stream else ytdl.prepare_filename(data)
+        if stream:
+            return cls.from_data(await cls.resolve(url))
+
+        def download(ytdl):
+            data = ytdl.extract_info(url, download=True)
+            if 'entries' in data:
+                data = data['entries'][0]
+            return data, ytdl.prepare_filename(data)
+
+        data, filename = await extractor.run(download)
         return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data)
 
+class YTDLOpusSource(TrackSource, discord.FFmpegOpusAudio):
+    def __init__(self, data, *, volume=0.5, start=0, path=None):
+        # Opus streams at full volume go straight through, everything else
+        # is scaled and encoded by FFmpeg instead of frame by frame in Python.
+        # Files from the audio cache are always Opus.
+        passthrough = volume == 1.0 and ((path is not None and not is_local(data)) or data.get('acodec') == 'opus')
+        options = ffmpeg_options['options']
+        if not passthrough:
+            options += f" -filter:a volume={volume:.2f}"
+        before_options = ffmpeg_before_options(start, local=path is not None)
+        super().__init__(path or data['url'], codec='copy' if passthrough else None, before_options=before_options, options=options)
+        self.volume = volume
+        self.passthrough = passthrough
+        self.set_track(data, start)
+
+def make_source(data, *, volume=0.5, start=0):
+    path = data['url'] if is_local(data) else audio_cache.get(data.get('id'))
+    if PLAYBACK_MODE == 'opus':
+        return YTDLOpusSource(data, volume=volume, start=start, path=path)
+    return YTDLSource.from_data(data, volume=volume, start=start, path=path)
+
+# Broadcast (radio) mode
+BROADCAST_BUFFER = 500  # Opus packets (10s) a station keeps for its listeners
+BROADCAST_CUSHION = 25  # packets a listener stays behind the decoder to ride out jitter
+BROADCAST_LINGER = 30  # seconds a station keeps decoding after its last listener leaves
+OPUS_SILENCE = b'\xf8\xff\xfe'
+
+class Broadcast:
+    """One FFmpeg decode of a stream, written as Opus packets into a ring buffer
+
+    A single thread reads the stream in real time and every guild tuned in
+    reads the same packets through its own BroadcastReader, so a station
+    costs one FFmpeg process and one encode however many guilds listen.
+    """
+    def __init__(self, key, data):
+        self.key = key
+        self.data = data
+        self.packets = [None] * BROADCAST_BUFFER
+        self.head = 0  # sequence number of the next packet written
+        self.ended = False
+        self.listeners = 0
+        self.cond = threading.Condition()
+        # -re paces the decode to real time, a finished download would otherwise flood the buffer
+        self.source = discord.FFmpegOpusAudio(
+            data['url'], codec='copy' if data.get('acodec') == 'opus' else None,
+            before_options=f"-re {ffmpeg_before_options(local=is_local(data))}".strip(), options=ffmpeg_options['options'])
+        self.thread = threading.Thread(target=self.pump, name=f"broadcast-{key}", daemon=True)
+        self.thread.start()
+
+    def pump(self):
+        try:
+            while not self.ended:
+                packet = self.source.read()
+                if not packet:
+                    break
+                with self.cond:
+                    self.packets[self.head % BROADCAST_BUFFER] = packet
+                    self.head += 1
+                    self.cond.notify_all()
+        finally:
+            with self.cond:
+                self.ended = True
+                self.cond.notify_all()
+            self.source.cleanup()
+
+    def read(self, offset, timeout=0.5):
+        """Return (packet, next offset) for a listener at offset"""
+        with self.cond:
+            if offset < self.head - BROADCAST_BUFFER:
+                # Fell out of the buffer (a stalled voice connection), skip to near live
+                offset = max(0, self.head - BROADCAST_CUSHION)
+            if offset >= self.head and not self.ended:
+                self.cond.wait(timeout)
+            if offset < self.head:
+                return self.packets[offset % BROADCAST_BUFFER], offset + 1
+            if self.ended:
+                return b'', offset
+        # The stream is stalling, keep the voice connection fed until it recovers
+        return OPUS_SILENCE, offset
+
+    def join(self):
+        with self.cond:
+            self.listeners += 1
+            return max(0, self.head - BROADCAST_CUSHION)
+
+    def leave(self):
+        with self.cond:
+            self.listeners -= 1
+
+    def stop(self):
+        self.ended = True
+        # Unblocks the pump if FFmpeg is stuck waiting on the stream
+        self.source.cleanup()
+
+class BroadcastReader(TrackSource, discord.AudioSource):
+    """One guild's position in a shared Broadcast"""
+    def __init__(self, station, hub):
+        self.station = station
+        self.hub = hub
+        self.offset = station.join()
+        self.closed = False
+        self.set_track(station.data)
+
+    def read(self):
+        packet, self.offset = self.station.read(self.offset)
+        if packet:
+            self.frames += 1
+        return packet
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        if not self.closed:
+            self.closed = True
+            self.station.leave()
+            self.hub.release(self.station)
+
+class BroadcastHub:
+    """Running stations by track, started on first tune-in and stopped once nobody listens"""
+    def __init__(self):
+        self.stations = {}
+        self.loop = None
+
+    def subscribe(self, data):
+        self.loop = asyncio.get_running_loop()
+        key = data.get('id') or data['url']
+        station = self.stations.get(key)
+        if station is None or station.ended:
+            station = self.stations[key] = Broadcast(key, data)
+        return BroadcastReader(station, self)
+
+    def release(self, station):
+        # Called from voice threads, wait a little in case someone tunes straight back in
+        delay = 0 if station.ended else BROADCAST_LINGER
+        try:
+            self.loop.call_soon_threadsafe(self.loop.call_later, delay, self.reap, station)
+        except RuntimeError:
+            pass  # the event loop has already shut down
+
+    def reap(self, station):
+        if station.listeners <= 0:
+            station.stop()
+            if self.stations.get(station.key) is station:
+                del self.stations[station.key]
+
+broadcasts = BroadcastHub()
+
+class Song:
+    """A queued track, holding IDs and strings rather than live discord objects"""
+    __slots__ = ('id', 'webpage_url', 'url', 'title', 'duration', 'thumbnail', 'uploader', 'acodec', 'requester_id', 'requester_name')
+
+    def __init__(self, id, webpage_url, title, *, url=None, duration=None, thumbnail=None, uploader=None, acodec=None, requester=None):
+        self.id = id
+        self.webpage_url = webpage_url
+        self.url = url
+        self.title = title
+        self.duration = duration
+        self.thumbnail = thumbnail
+        self.uploader = uploader
+        self.acodec = acodec
+        self.requester_id = requester.id if requester else None
+        self.requester_name = requester.display_name if requester else None
+
+    @classmethod
+    def from_info(cls, data, requester=None):
+        return cls(
+            data['id'], data.get('webpage_url'), data.get('title') or data['id'],
+            url=data.get('url'), duration=data.get('duration'), thumbnail=data.get('thumbnail'),
+            uploader=data.get('uploader'), acodec=data.get('acodec'), requester=requester
+        )
+
+    def update(self, data):
+        """Take the fresh stream URL and details from a new extraction of this song"""
+        self.url = data.get('url')
+        self.duration = data.get('duration') or self.duration
+        self.thumbnail = data.get('thumbnail') or self.thumbnail
+        self.acodec = data.get('acodec')
+
+    def info(self):
+        return {field: getattr(self, field, None) for field in TRACK_FIELDS}
+
+    def snapshot(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        song = cls.__new__(cls)
+        for field in cls.__slots__:
+            setattr(song, field, snapshot.get(field))
+        return song
+
+    def footprint(self):
+        return sys.getsizeof(self) + sum(sys.getsizeof(getattr(self, field)) for field in self.__slots__)
+
+def song_url(song):
+    if isinstance(song, TrackSource):
+        return song.data.get('webpage_url') or song.url
+    return song.webpage_url or song.url
+
+class SongQueue:
+    """Song queue with O(log n) indexing, removal and random draws
+
+    Songs sit in append-only slots and removed slots become None. A Fenwick
+    tree counts the live slots so the n-th song and a uniformly random song
+    can be found without walking the queue. Slots are compacted once more
+    than half of them are dead.
+
+    When the player is being saved, every change is also appended to
+    journal as an (op, index, song) tuple for StateStore to write out.
+    """
+    def __init__(self, songs=(), journal=None):
+        self.journal = journal
+        self.rebuild(songs)
+
+    def record(self, op, index=None, song=None):
+        if self.journal is not None:
+            self.journal.append((op, index, song))
+
+    def rebuild(self, songs):
+        self.slots = list(songs)
+        self.head = 0
+        self.count = len(self.slots)
+        self.slot_of = {id(song): slot for slot, song in enumerate(self.slots)}
+        self.tree = [0] + [1] * self.count
+        for i in range(1, self.count + 1):
+            parent = i + (i & -i)
+            if parent <= self.count:
+                self.tree[parent] += self.tree[i]
+
+    def clear(self):
+        self.record('clear')
+        self.rebuild(())
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for slot in range(self.head, len(self.slots)):
+            song = self.slots[slot]
+            if song is not None:
+                yield song
+
+    def __contains__(self, song):
+        slot = self.slot_of.get(id(song))
+        return slot is not None and self.slots[slot] is song
+
+    def __getitem__(self, index):
+        return self.slots[self.find(self.normalize(index))]
+
+    def normalize(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('queue index out of range')
+        return index
+
+    def update(self, slot, delta):
+        slot += 1
+        while slot < len(self.tree):
+            self.tree[slot] += delta
+            slot += slot & -slot
+
+    def rank(self, slot):
+        """Number of live songs in the slots before slot"""
+        index = 0
+        while slot:
+            index += self.tree[slot]
+            slot -= slot & -slot
+        return index
+
+    def find(self, index):
+        """Slot holding the index-th live song"""
+        slot = 0
+        remaining = index + 1
+        step = 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            nxt = slot + step
+            if nxt < len(self.tree) and self.tree[nxt] < remaining:
+                slot = nxt
+                remaining -= self.tree[nxt]
+            step >>= 1
+        return slot
+
+    def append(self, song):
+        self.slots.append(song)
+        self.slot_of[id(song)] = len(self.slots) - 1
+        # A new Fenwick node covers itself plus the nodes just below it
+        node = len(self.slots)
+        total = 1
+        child = node - 1
+        while child > node - (node & -node):
+            total += self.tree[child]
+            child -= child & -child
+        self.tree.append(total)
+        self.count += 1
+        self.record('append', song=song)
+
+    def kill(self, slot):
+        song = self.slots[slot]
+        self.record('pop', self.rank(slot))
+        self.slots[slot] = None
+        del self.slot_of[id(song)]
+        self.update(slot, -1)
+        self.count -= 1
+        dead = len(self.slots) - self.count
+        if dead > 64 and dead > self.count:
+            self.rebuild(list(self))
+        return song
+
+    def popleft(self):
+        if not self.count:
+            raise IndexError('pop from an empty queue')
+        while self.slots[self.head] is None:
+            self.head += 1
+        return self.kill(self.head)
+
+    def pop(self, index=0):
+        return self.kill(self.find(self.normalize(index)))
+
+    def pop_random(self):
+        return self.pop(random.randrange(self.count))
+
+    def choice(self):
+        return self[random.randrange(self.count)]
+
+    def remove(self, song):
+        """Remove this exact song object, returning whether it was queued"""
+        if song not in self:
+            return False
+        self.kill(self.slot_of[id(song)])
+        return True
+
+    def move(self, src, dst):
+        # Moves are rare and user driven, so an O(n) rebuild keeps the rest simple
+        song = self.pop(src)
+        songs = list(self)
+        dst = max(0, min(dst, len(songs)))
+        songs.insert(dst, song)
+        self.rebuild(songs)
+        self.record('insert', dst, song)
+        return song
+
+    def jump(self, index):
+        """Drop the first index songs so the song at index is next"""
+        index = self.normalize(index)
+        for _ in range(index):
+            self.popleft()
+
+    def page(self, page, size=10):
+        start = page * size
+        if start >= self.count:
+            return []
+        songs = []
+        for slot in range(self.find(start), len(self.slots)):
+            song = self.slots[slot]
+            if song is not None:
+                songs.append(song)
+                if len(songs) == size:
+                    break
+        return songs
+
+# Outbound messages
+CHANNEL_RATE = 5  # messages per CHANNEL_PER seconds, Discord's per-channel allowance
+CHANNEL_PER = 5.0
+MESSAGE_STALE = float(os.getenv('MESSAGE_STALE', '15'))  # drop updates still waiting for a slot after this many seconds
+COALESCE_DELAY = float(os.getenv('COALESCE_DELAY', '1.0'))  # gather bursts of updates this long before flushing them
+NOTICE_WINDOW = 30  # seconds an "Added to Queue" message keeps collecting songs
+NOTICE_LINES = 10
+
+class TokenBucket:
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take a token if one is free, otherwise return the seconds until one will be"""
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) * self.per / self.rate
+
+    async def acquire(self, deadline):
+        """Wait for a token, giving up if it would not be free before deadline"""
+        while True:
+            delay = self.take()
+            if not delay:
+                return True
+            if time.monotonic() + delay > deadline:
+                return False
+            await asyncio.sleep(delay)
+
+    def idle(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate / self.per >= self.rate
+
+class LiveMessage:
+    """A message kept up to date by editing it, with the change still waiting to be flushed"""
+    __slots__ = ('channel', 'message', 'embed', 'lines', 'more', 'pending_since', 'task', 'updated')
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.message = None
+        self.embed = None
+        self.lines = deque(maxlen=NOTICE_LINES)
+        self.more = 0
+        self.pending_since = None
+        self.task = None
+        self.updated = 0
+
+    def render(self):
+        if self.embed is not None:
+            return self.embed
+        count = len(self.lines) + self.more
+        description = '\n'.join(self.lines)
+        if self.more:
+            description = f"...and {self.more} earlier\n" + description
+        return discord.Embed(
+            title=f"{EMOJIS['success']} Added to Queue" if count == 1 else f"{EMOJIS['success']} Added {count} songs to Queue",
+            description=description,
+            color=0x00ff00
+        )
+
+def is_latest(channel, message):
+    return message is not None and getattr(channel, 'last_message_id', None) == getattr(message, 'id', None)
+
+class MessageBus:
+    """Channel messages paced per channel, so busy guilds stay under Discord's rate limits
+
+    Each guild has one now-playing message that is edited in place, and bursts
+    of queued songs are gathered into a single notice. Updates are flushed at
+    most once per COALESCE_DELAY, only the latest content is sent, and anything
+    still waiting for a free slot after MESSAGE_STALE seconds is dropped.
+    """
+    def __init__(self):
+        self.buckets = {}
+        self.now_playing = {}
+        self.notices = {}
+
+    def bucket(self, channel):
+        bucket = self.buckets.get(channel.id)
+        if bucket is None:
+            bucket = self.buckets[channel.id] = TokenBucket(CHANNEL_RATE, CHANNEL_PER)
+        return bucket
+
+    async def send(self, channel, **kwargs):
+        """Send once the channel has a free slot, or drop the message if it goes stale first"""
+        if not await self.bucket(channel).acquire(time.monotonic() + MESSAGE_STALE):
+            metrics.messages_dropped.inc()
+            return None
+        metrics.messages_sent.inc()
+        return await channel.send(**kwargs)
+
+    def post(self, channel, **kwargs):
+        """send() without waiting for it"""
+        return bot.loop.create_task(self.send(channel, **kwargs))
+
+    def set_now_playing(self, guild_id, channel, embed):
+        live = self.now_playing.get(guild_id)
+        if live is None or live.channel.id != channel.id:
+            live = self.now_playing[guild_id] = LiveMessage(channel)
+        live.embed = embed
+        self.schedule(live)
+
+    def queued(self, channel, song, position):
+        live = self.notices.get(channel.id)
+        if (live is None or time.monotonic() - live.updated > NOTICE_WINDOW
+                or (live.message is not None and not is_latest(channel, live.message))):
+            live = self.notices[channel.id] = LiveMessage(channel)
+        if len(live.lines) == live.lines.maxlen:
+            live.more += 1
+        requester = f" - {song.requester_name}" if song.requester_name else ""
+        live.lines.append(f"`{position}.` **{song.title}**{requester}")
+        self.schedule(live)
+
+    def schedule(self, live):
+        now = time.monotonic()
+        # A lone update goes out straight away, one in the middle of a burst waits for the rest
+        delay = COALESCE_DELAY if now - live.updated < COALESCE_DELAY else 0
+        live.updated = now
+        if live.pending_since is None:
+            live.pending_since = now
+        if live.task is None:
+            live.task = bot.loop.create_task(self.flush(live, delay))
+
+    async def flush(self, live, delay):
+        try:
+            await asyncio.sleep(delay)
+            fresh = await self.bucket(live.channel).acquire(live.pending_since + MESSAGE_STALE)
+            live.pending_since = None
+            if not fresh:
+                metrics.messages_dropped.inc()
+                return
+            embed = live.render()
+            if is_latest(live.channel, live.message):
+                try:
+                    await live.message.edit(embed=embed)
+                    metrics.messages_sent.inc()
+                    return
+                except discord.NotFound:
+                    live.message = None
+            # Buried under newer messages, post it again at the bottom
+            if live.message is not None and live.embed is not None:
+                bot.loop.create_task(self.delete(live.message))
+            live.message = await live.channel.send(embed=embed)
+            metrics.messages_sent.inc()
+        except discord.HTTPException as e:
+            print(f"Could not update message in {live.channel.id}: {e}")
+        except asyncio.CancelledError:
+            # Dropped on purpose, don't let the finally below send it anyway
+            live.pending_since = None
+            raise
+        finally:
+            live.task = None
+            if live.pending_since is not None:
+                # More changes came in while this one was going out
+                self.schedule(live)
+
+    async def delete(self, message):
+        try:
+            await message.delete()
+        except discord.HTTPException:
+            pass
+
+    def forget(self, guild_id):
+        live = self.now_playing.pop(guild_id, None)
+        if live and live.task:
+            live.pending_since = None
+            live.task.cancel()
+
+    def prune(self):
+        """Drop bookkeeping for channels that have gone quiet"""
+        now = time.monotonic()
+        for channel_id, live in list(self.notices.items()):
+            if live.task is None and now - live.updated > NOTICE_WINDOW:
+                del self.notices[channel_id]
+        for channel_id, bucket in list(self.buckets.items()):
+            if bucket.idle():
+                del self.buckets[channel_id]
+
+messages = MessageBus()
+
+HISTORY_SIZE = 10  # finished songs each player remembers
+
 class MusicPlayer:
-    def __init__(self, bot):
+    def __init__(self, bot, guild_id=None):
         self.bot = bot
-        self.queue = deque()
-        self.history = deque(maxlen=10)
+        self.guild_id = guild_id
+        # Queue and history changes waiting to be saved, see StateStore
+        self.journal = [] if state.db_path else None
+        self.queue = SongQueue(journal=self.journal)
+        self.history = deque(maxlen=HISTORY_SIZE)
         self.current = None
         self.voice_client = None
         self.volume = 0.5
         self.loop = False
         self.shuffle = False
         self.paused = False
+        # Prefetch stage: the song picked to play next and its warmed-up source
+        self.up_next = None
+        self.prefetch_task = None
+        self.prefetched = None
+        # Set by jump so play_next moves on even with loop on
+        self.jumping = False
+        # Silence between one track ending and the next one starting, in seconds
+        self.track_started = None
+        self.track_ended = None
+        # Stop flags of playlists still being read into the queue
+        self.ingestions = set()
+        self.last_active = time.monotonic()
+        # When a play command asked for audio, until playback actually starts
+        self.requested_at = None
+        self.last_gap = None
+        self.transition_gaps = deque(maxlen=50)
+        # Where now-playing messages go, remembered so playback can resume after a restart
+        self.text_channel_id = None
+        # Set when playback is stopped on purpose, so an early end is not mistaken for a dropout
+        self.stopping = False
+        self.resume_attempts = 0
+        # Set while resume() drops and re-opens the voice connection itself
+        self.reconnecting = False
+        # Background re-resolution of queued stream URLs before they expire
+        self.refresh_task = None
+        self.refresh_at = None
+        self.refresh_wakeup = asyncio.Event()
+        # id(song) -> (song, not before, backoff) for songs whose next refresh is held back,
+        # after a failure or a refresh that came back short-lived; None means never again
+        self.refresh_holds = {}
         
     def is_playing(self):
         return self.voice_client and self.voice_client.is_playing()
@@ -103,75 +1776,781 @@ class MusicPlayer:
     
     async def add_to_queue(self, song):
         self.queue.append(song)
-    
-    async def play_next(self, ctx):
+        self.queue_changed()
+        self.schedule_refresh(song)
+
+    def queue_changed(self):
+        """Redo the prefetch if the song it picked is no longer next in line"""
+        if not (self.is_playing() or self.is_paused()) or (self.loop and self.current):
+            return
+        if self.shuffle:
+            still_next = self.up_next is not None and self.up_next in self.queue
+        else:
+            still_next = bool(self.queue) and self.queue[0] is self.up_next
+        if not still_next:
+            self.schedule_prefetch()
+
+    def jump(self, index):
+        self.queue.jump(index)
+        self.cancel_prefetch()
+        self.up_next = self.queue[0]
+        self.jumping = True
+        self.skip()
+
+    def skip(self):
+        """Stop the current track on purpose, moving on to the next one"""
+        self.stopping = True
+        self.voice_client.stop()
+
+    async def add_playlist(self, ctx, url):
+        """Queue a playlist entry by entry as it is read, starting playback with the first"""
+        loop = asyncio.get_running_loop()
+        entries = asyncio.Queue()
+        stop = threading.Event()
+        self.ingestions.add(stop)
+        job = asyncio.ensure_future(extractor.run(
+            lambda ytdl: stream_playlist(ytdl, url, lambda entry: loop.call_soon_threadsafe(entries.put_nowait, entry), stop),
+            guild_id=self.guild_id, timeout=PLAYLIST_TIMEOUT, profile='playlist', priority=PRIORITY_BULK))
+        try:
+            while True:
+                getter = asyncio.ensure_future(entries.get())
+                await asyncio.wait((getter, job), return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    # Entries are handed over before the job finishes, so none are left
+                    getter.cancel()
+                    break
+                entry = getter.result()
+                if stop.is_set():
+                    break
+                await self.add_to_queue(Song.from_info(flat_info(entry), ctx.author))
+                if not (self.is_playing() or self.is_paused()):
+                    await self.play_next(ctx)
+            return await job
+        finally:
+            stop.set()
+            self.ingestions.discard(stop)
+            job.cancel()
+
+    def cancel_ingestion(self):
+        for stop in self.ingestions:
+            stop.set()
+
+    async def shutdown(self):
+        """Drop the queue, stop pending work and leave voice"""
+        self.cancel_ingestion()
+        self.queue.clear()
+        self.cancel_prefetch()
+        self.cancel_refresh()
+        self.current = None
+        messages.forget(self.guild_id)
+        state.forget(self.guild_id)
+        if self.journal:
+            self.journal.clear()
+        extractor.cancel_guild(self.guild_id)
+        if self.voice_client:
+            self.stopping = True
+            # Cleared first so the voice state update this causes isn't taken for a kick
+            voice_client, self.voice_client = self.voice_client, None
+            await voice_client.disconnect()
+
+    def footprint(self):
+        """Rough size in bytes of this player and its queue"""
+        size = sys.getsizeof(self) + sys.getsizeof(self.__dict__)
+        size += sys.getsizeof(self.queue.slots) + sys.getsizeof(self.queue.tree) + sys.getsizeof(self.queue.slot_of)
+        size += sum(song.footprint() for song in self.queue)
+        size += sum(song.footprint() for song in self.history)
+        return size
+
+    def schedule_prefetch(self):
+        """(Re)pick the next song and start resolving it while the current one plays"""
+        self.cancel_prefetch()
         if self.loop and self.current:
-            source = await YTDLSource.from_url(self.current.url, loop=self.bot.loop, stream=True)
-            self.voice_client.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(self.play_next(ctx), self.bot.loop))
+            if isinstance(self.current, BroadcastReader):
+                # Looping a broadcast tunes back in, there is nothing to warm up
+                return
+            self.up_next = self.current
+        elif self.queue:
+            self.up_next = self.queue.choice() if self.shuffle else self.queue[0]
+        else:
             return
-            
-        if not self.queue:
+        self.prefetch_task = self.bot.loop.create_task(self.prefetch(self.up_next))
+
+    def cancel_prefetch(self):
+        self.up_next = None
+        if self.prefetch_task:
+            self.prefetch_task.cancel()
+            self.prefetch_task = None
+        if self.prefetched:
+            self.prefetched[1].cleanup()
+            self.prefetched = None
+
+    async def prefetch(self, song):
+        try:
+            data = await self.resolve(song, PRIORITY_BULK)
+        except Exception as e:
+            # play_next will retry the resolution and report the error
+            print(f"Prefetch failed: {e}")
             return
-            
+
+        try:
+            # Hold off spawning FFmpeg until the current track is nearly done
+            if self.current and self.current.duration:
+                remaining = self.current.duration - self.current.position
+                await asyncio.sleep(max(0, remaining - PREFETCH_LEAD))
+                # A cached file may have been evicted or a URL run out meanwhile,
+                # resolving again costs nothing while the data is still good
+                data = await self.resolve(song, PRIORITY_BULK)
+            self.prefetched = (song, make_source(data, volume=self.volume))
+        except Exception as e:
+            print(f"Prefetch failed: {e}")
+
+    def schedule_refresh(self, song):
+        """Make sure the refresher knows about song's stream URL expiring"""
+        expires = stream_expiry(song.url)
+        if expires is None:
+            return
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = self.bot.loop.create_task(self.refresh_streams())
+        elif self.refresh_at is None or expires - REFRESH_LEAD < self.refresh_at:
+            self.refresh_wakeup.set()
+
+    def cancel_refresh(self):
+        if self.refresh_task:
+            self.refresh_task.cancel()
+            self.refresh_task = None
+        self.refresh_at = None
+        self.refresh_holds.clear()
+
+    async def refresh_streams(self):
+        """Re-resolve queued songs shortly before their stream URLs expire, front of the queue first"""
+        while self.queue:
+            now = time.time()
+            due = []
+            self.refresh_at = None
+            if self.refresh_holds:
+                self.refresh_holds = {key: hold for key, hold in self.refresh_holds.items() if hold[0] in self.queue}
+            for song in self.queue:
+                expires = stream_expiry(song.url)
+                if expires is None:
+                    continue
+                refresh_at = expires - REFRESH_LEAD
+                hold = self.refresh_holds.get(id(song))
+                if hold:
+                    if hold[1] is None:
+                        continue
+                    refresh_at = max(refresh_at, hold[1])
+                if refresh_at <= now:
+                    due.append(song)
+                    if len(due) >= REFRESH_CONCURRENCY:
+                        break
+                elif self.refresh_at is None or refresh_at < self.refresh_at:
+                    self.refresh_at = refresh_at
+            if due:
+                await asyncio.gather(*(self.refresh_song(song) for song in due))
+                continue
+
+            self.refresh_wakeup.clear()
+            timeout = None if self.refresh_at is None else self.refresh_at - now
+            try:
+                await asyncio.wait_for(self.refresh_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.refresh_at = None
+
+    async def refresh_song(self, song):
+        try:
+            data = await extractor.extract(song_url(song), guild_id=self.guild_id, key=song.id, priority=PRIORITY_BULK)
+            if 'entries' in data:
+                data = data['entries'][0]
+        except Exception as e:
+            # Failures such as a full extraction queue are often temporary,
+            # keep the URL we have and try again for as long as it works
+            now = time.time()
+            expires = stream_expiry(song.url)
+            if expires is None or expires - STREAM_EXPIRY_MARGIN <= now:
+                # Leave it to play_next to resolve it again and report the error
+                print(f"Could not refresh {song.title}: {e}")
+                self.refresh_holds.pop(id(song), None)
+                song.url = None
+                return
+            backoff = self.refresh_holds.get(id(song), (song, now, REFRESH_RETRY / 2))[2] * 2
+            self.refresh_holds[id(song)] = (song, min(now + backoff, expires - STREAM_EXPIRY_MARGIN), backoff)
+            return
+        old_expires = stream_expiry(song.url)
+        song.update(track_cache.put(data, song_url(song)))
+        now = time.time()
+        expires = stream_expiry(song.url)
+        if expires is None or (old_expires and expires <= old_expires):
+            # Refreshing bought nothing, leave it to play_next to resolve when it's up
+            self.refresh_holds[id(song)] = (song, None, REFRESH_RETRY)
+        elif expires - REFRESH_LEAD <= now:
+            # The host hands out URLs shorter lived than REFRESH_LEAD, refresh
+            # again halfway to expiry instead of straight away
+            self.refresh_holds[id(song)] = (song, now + max(REFRESH_RETRY, (expires - now) / 2), REFRESH_RETRY / 2)
+        else:
+            self.refresh_holds.pop(id(song), None)
+
+    async def resolve(self, song, priority=PRIORITY_NOW):
+        """Track info needed to play song, without a stream URL when the audio is on disk"""
+        data = song.data if isinstance(song, TrackSource) else song.info()
+        if is_local(data) or audio_cache.get(data.get('id')):
+            return data
+        expires = stream_expiry(data.get('url'))
+        if expires and expires - STREAM_EXPIRY_MARGIN > time.time():
+            # Still good, whether from the original lookup or the refresher
+            return data
+        return await YTDLSource.resolve(song_url(song), guild_id=self.guild_id, priority=priority)
+
+    def take_prefetched(self, song):
+        """Return the warmed-up source for song, if the prefetch got that far"""
+        prefetched, self.prefetched = self.prefetched, None
+        self.cancel_prefetch()
+        if prefetched and prefetched[0] is song:
+            return prefetched[1]
+        if prefetched:
+            prefetched[1].cleanup()
+        return None
+
+    def take_next(self):
+        song = self.up_next
         if self.shuffle:
-            import random
-            song = random.choice(self.queue)
-            self.queue.remove(song)
+            if song is None or not self.queue.remove(song):
+                song = self.queue.pop_random()
         else:
             song = self.queue.popleft()
+        return song
+
+    async def set_volume(self, volume):
+        self.volume = volume
+        state.mark(self)
+        source = self.voice_client.source if self.voice_client else None
+        if isinstance(source, YTDLSource):
+            source.volume = volume
+        elif isinstance(source, YTDLOpusSource) and source.volume != volume:
+            # FFmpeg owns the volume on the Opus path, restart it where we are,
+            # or for a live stream at the live edge, which -ss can't seek in
+            await self.restart(0 if is_live(source.data) else source.position)
+        if self.prefetched:
+            self.schedule_prefetch()
+
+    async def seek(self, position):
+        """Move the current track to position seconds, returning where it landed"""
+        position = max(0, position)
+        if self.current.duration:
+            position = min(position, max(0, self.current.duration - 1))
+        await self.restart(position)
+        state.mark(self)
+        return position
+
+    async def restart(self, position):
+        """Swap in a fresh source for the current track starting at position"""
+        old = self.voice_client.source
+        data = old.data
+        expires = stream_expiry(data.get('url'))
+        if expires and expires - STREAM_EXPIRY_MARGIN < time.time() and not audio_cache.get(data.get('id')):
+            data = await self.resolve(old)
+            if self.voice_client.source is not old:
+                return
+        # FFmpeg seeks the stream URL we already have, no new extraction
+        self.swap(make_source(data, volume=self.volume, start=position))
+
+    def swap(self, source):
+        """Replace what is playing without ending the track"""
+        old = self.voice_client.source
+        paused = self.voice_client.is_paused()
+        self.voice_client.source = source
+        if paused:
+            self.voice_client.pause()
+        self.current = source
+        # The voice thread may still be inside old.read(), give it a moment
+        self.bot.loop.call_later(1, old.cleanup)
+
+    def start(self, ctx, source, resumed=False):
+        self.stopping = False
+        self.text_channel_id = ctx.channel.id
+        state.mark(self)
+        self.voice_client.play(source, after=lambda e: self.track_finished(ctx, e))
+        self.track_started = self.last_active = time.monotonic()
+        if resumed:
+            self.track_ended = None
+            return
+        metrics.tracks_started.inc()
+        if self.requested_at is not None:
+            metrics.first_audio_seconds.observe(self.track_started - self.requested_at)
+            self.requested_at = None
+        search_index.add(source.data)
+        if audio_cache.wants(source.data):
+            audio_cache.schedule(source.data)
+        if self.track_ended is not None:
+            self.last_gap = self.track_started - self.track_ended
+            self.transition_gaps.append(self.last_gap)
+            metrics.transition_gap_seconds.observe(self.last_gap)
+            self.track_ended = None
+        self.schedule_prefetch()
+
+    def track_finished(self, ctx, error=None):
+        # Runs in the voice thread once the source is exhausted or stopped
+        self.track_ended = time.monotonic()
+        if error:
+            print(f"Player error: {error}")
+        source = self.current
+        # A broadcast's position only counts what this guild heard since tuning in,
+        # so the station ending is never a dropout to pick back up
+        if (not self.stopping and source and source.duration and not isinstance(source, BroadcastReader)
+                and self.resume_attempts < RESUME_ATTEMPTS and source.position < source.duration - RESUME_SLACK):
+            # Cut off early by a dropped voice connection or stream, pick up where it stopped
+            asyncio.run_coroutine_threadsafe(self.resume(ctx, source), self.bot.loop)
+            return
+        asyncio.run_coroutine_threadsafe(self.play_next(ctx), self.bot.loop)
+
+    async def resume(self, ctx, source):
+        """Restart the interrupted track at the position it reached, reconnecting to voice if needed"""
+        self.resume_attempts += 1
+        position = source.position
+        if not self.voice_client.is_connected():
+            # discord.py reconnects on its own after short outages, give it the chance first
+            for _ in range(RESUME_WAIT):
+                await asyncio.sleep(1)
+                if self.voice_client is None or self.stopping or self.voice_client.is_connected():
+                    break
+            else:
+                channel = self.voice_client.channel
+                self.reconnecting = True
+                try:
+                    await self.voice_client.disconnect(force=True)
+                    self.voice_client = await channel.connect()
+                except Exception as e:
+                    print(f"Could not reconnect to voice in {self.guild_id}: {e}")
+                    return
+                finally:
+                    self.reconnecting = False
+        if self.voice_client is None or self.stopping or self.current is not source:
+            return
+        try:
+            data = await self.resolve(source)
+            resumed = make_source(data, volume=self.volume, start=position)
+        except Exception as e:
+            print(f"Could not resume {source.title} at {format_timestamp(position)}: {e}")
+            await self.play_next(ctx)
+            return
+        self.current = resumed
+        self.start(ctx, resumed, resumed=True)
+
+    async def play_next(self, ctx):
+        self.resume_attempts = 0
+        jumping, self.jumping = self.jumping, False
+        if self.loop and self.current and not jumping:
+            source = self.take_prefetched(self.current)
+            if isinstance(self.current, BroadcastReader):
+                source = broadcasts.subscribe(self.current.data)
+            elif source is None:
+                data = await self.resolve(self.current)
+                source = make_source(data, volume=self.volume)
+            self.current = source
+            self.start(ctx, source)
+            return
+            
+        if not self.queue:
+            self.cancel_prefetch()
+            self.track_ended = None
+            return
+            
+        song = self.take_next()
+        source = self.take_prefetched(song)
             
         if self.current:
-            self.history.append(self.current)
+            self.remember(Song.from_info(self.current.data))
+            
+        try:
+            if source is None:
+                data = await self.resolve(song)
+                source = make_source(data, volume=self.volume)
+            self.current = source
+            self.start(ctx, source)
+            self.announce(ctx, source)
             
+        except Exception as e:
+            embed = discord.Embed(
+                title=f"{EMOJIS['error']} Error",
+                description=f"Could not play the song: {str(e)}",
+                color=0xff0000
+            )
+            messages.post(ctx.channel, embed=embed)
+            await self.play_next(ctx)
+
+    def remember(self, song):
+        self.history.append(song)
+        if self.journal is not None:
+            self.journal.append(('history', None, song))
+
+    async def restore(self, ctx, song, position, paused=False):
+        """Start song part way through, as it was playing before a restart"""
+        data = await self.resolve(song)
+        source = make_source(data, volume=self.volume, start=0 if is_live(data) else position)
+        self.current = source
+        self.start(ctx, source)
+        if paused:
+            self.voice_client.pause()
+            self.paused = True
+        self.announce(ctx, source)
+
+    def announce(self, ctx, source):
+        embed = discord.Embed(
+            title=f"{EMOJIS['music']} Now Playing",
+            description=f"**{source.title}**",
+            color=0x00ff00
+        )
+        if source.thumbnail:
+            embed.set_thumbnail(url=source.thumbnail)
+        if source.uploader:
+            embed.add_field(name=f"{EMOJIS['microphone']} Uploader", value=source.uploader, inline=True)
+        if source.duration:
+            mins, secs = divmod(source.duration, 60)
+            embed.add_field(name=f"{EMOJIS['info']} Duration", value=f"{int(mins):02d}:{int(secs):02d}", inline=True)
+        
+        messages.set_now_playing(self.guild_id, ctx.channel, embed)
+
+# Global music players for each guild
+music_players = {}
+
+RESUME_ATTEMPTS = 3  # times one track is picked back up after cutting out early
+RESUME_SLACK = 3  # seconds short of the reported duration that still counts as finished
+RESUME_WAIT = 10  # seconds to let discord.py restore a dropped voice connection before reconnecting
+
+IDLE_TIMEOUT = int(os.getenv('IDLE_TIMEOUT', '600'))  # seconds without playback or commands before a player is evicted
+
+def get_player(guild_id):
+    if guild_id not in music_players:
+        music_players[guild_id] = MusicPlayer(bot, guild_id)
+    player = music_players[guild_id]
+    player.last_active = time.monotonic()
+    return player
+
+# Persistent player state
+STATE_DB = os.getenv('STATE_DB', 'state.db')  # SQLite file players are saved to, empty to disable
+STATE_FLUSH = float(os.getenv('STATE_FLUSH', '5'))  # seconds between writes of changed players
+STATE_COMPACT = 200  # journal entries a player may pile up before its queue is saved whole instead
+RESTORE_REWIND = 2  # seconds replayed before the saved position when resuming
+
+class StateStore:
+    """Snapshots of every player in SQLite, so playback survives restarts and deploys
+
+    Settings and the current track are one row per player, rewritten when a
+    command changes them. Queue and history changes go to a journal as they
+    happen, and only once a player's journal outgrows its queue is the queue
+    written out whole and the journal dropped. Everything is written every
+    STATE_FLUSH seconds on a worker thread; players that are only playing
+    just get their position updated.
+    """
+    def __init__(self, db_path=STATE_DB):
+        self.db_path = db_path
+        self.db = None
+        self.lock = threading.Lock()
+        self.dirty = set()
+        self.forgotten = set()
+        # guild_id -> journal entries written since its queue was last saved whole
+        self.journaled = {}
+        self.restored = False
+
+    def open(self):
+        if self.db is None and self.db_path:
+            # Used from whichever thread runs the flush, one at a time
+            self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS players (
+                guild_id INTEGER PRIMARY KEY, voice_channel_id INTEGER, text_channel_id INTEGER,
+                volume REAL, loop INTEGER, shuffle INTEGER, paused INTEGER,
+                current TEXT, position REAL, queue TEXT, history TEXT, saved REAL)''')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS journal (
+                id INTEGER PRIMARY KEY, guild_id INTEGER, op TEXT, position INTEGER, song TEXT)''')
+            self.db.commit()
+        return self.db
+
+    def mark(self, player):
+        if self.db_path:
+            self.dirty.add(player.guild_id)
+
+    def settings(self, player, now):
+        current = Song.from_info(player.current.data).snapshot() if player.current else None
+        voice_channel = player.voice_client.channel if player.voice_client else None
+        return (
+            player.guild_id, voice_channel.id if voice_channel else None, player.text_channel_id,
+            player.volume, int(player.loop), int(player.shuffle), int(bool(player.is_paused())),
+            json.dumps(current), player.current.position if player.current else 0, now
+        )
+
+    async def flush(self):
+        """Collect what changed since the last flush and write it on a worker thread"""
+        if not self.db_path:
+            return
+        now = time.time()
+        forgotten, self.forgotten = self.forgotten, set()
+        rows, positions, journals, snapshots = [], [], [], []
+        for guild_id, player in list(music_players.items()):
+            if guild_id in self.dirty:
+                rows.append(self.settings(player, now))
+            elif player.current is not None and player.is_playing():
+                positions.append((player.current.position, now, guild_id))
+            if not player.journal:
+                continue
+            entries = player.journal[:]
+            player.journal.clear()
+            written = self.journaled.get(guild_id)
+            if written is None or written + len(entries) > max(STATE_COMPACT, len(player.queue)):
+                # Cheaper to replay the queue itself than this much journal
+                snapshots.append((guild_id, list(player.queue), list(player.history)))
+                self.journaled[guild_id] = 0
+            else:
+                journals.extend((guild_id, op, index, song) for op, index, song in entries)
+                self.journaled[guild_id] = written + len(entries)
+        self.dirty.clear()
+        if forgotten or rows or positions or journals or snapshots:
+            await asyncio.to_thread(self.write, forgotten, rows, positions, journals, snapshots)
+
+    def write(self, forgotten, rows, positions, journals, snapshots):
+        db = self.open()
+        with self.lock, db:
+            gone = [(guild_id,) for guild_id in forgotten]
+            db.executemany('DELETE FROM players WHERE guild_id = ?', gone)
+            db.executemany('DELETE FROM journal WHERE guild_id = ?', gone)
+            db.executemany('''INSERT INTO players (guild_id, voice_channel_id, text_channel_id, volume, loop, shuffle, paused, current, position, saved)
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (guild_id) DO UPDATE SET
+                              voice_channel_id = excluded.voice_channel_id, text_channel_id = excluded.text_channel_id,
+                              volume = excluded.volume, loop = excluded.loop, shuffle = excluded.shuffle, paused = excluded.paused,
+                              current = excluded.current, position = excluded.position, saved = excluded.saved''', rows)
+            db.executemany('UPDATE players SET position = ?, saved = ? WHERE guild_id = ?', positions)
+            db.executemany('INSERT INTO journal (guild_id, op, position, song) VALUES (?, ?, ?, ?)', (
+                (guild_id, op, index, json.dumps(song.snapshot()) if song else None)
+                for guild_id, op, index, song in journals))
+            for guild_id, queue, history in snapshots:
+                db.execute('''INSERT INTO players (guild_id, queue, history) VALUES (?, ?, ?)
+                              ON CONFLICT (guild_id) DO UPDATE SET queue = excluded.queue, history = excluded.history''',
+                           (guild_id, json.dumps([song.snapshot() for song in queue]), json.dumps([song.snapshot() for song in history])))
+                db.execute('DELETE FROM journal WHERE guild_id = ?', (guild_id,))
+
+    def forget(self, guild_id):
+        self.dirty.discard(guild_id)
+        self.journaled.pop(guild_id, None)
+        if self.db_path:
+            self.forgotten.add(guild_id)
+
+    def load(self):
+        """Saved players with their journals replayed, queue and history as lists of snapshots"""
+        db = self.open()
+        if db is None:
+            return []
+        with self.lock:
+            players = db.execute('SELECT * FROM players').fetchall()
+            entries = db.execute('SELECT guild_id, op, position, song FROM journal ORDER BY id').fetchall()
+        journals = {}
+        for guild_id, op, index, song in entries:
+            journals.setdefault(guild_id, []).append((op, index, json.loads(song) if song else None))
+        rows = []
+        for row in players:
+            queue = json.loads(row[9] or '[]')
+            history = deque(json.loads(row[10] or '[]'), maxlen=HISTORY_SIZE)
+            for op, index, song in journals.get(row[0], ()):
+                if op == 'append':
+                    queue.append(song)
+                elif op == 'insert':
+                    queue.insert(index, song)
+                elif op == 'pop':
+                    del queue[index]
+                elif op == 'clear':
+                    queue.clear()
+                elif op == 'history':
+                    history.append(song)
+            rows.append(row[:9] + (queue, list(history)) + row[11:])
+        return rows
+
+state = StateStore()
+
+class ChannelContext:
+    """Just enough of a commands.Context for playback to carry on without a command"""
+    __slots__ = ('guild', 'channel')
+
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+
+@tasks.loop(seconds=STATE_FLUSH)
+async def flush_state():
+    try:
+        await state.flush()
+    except sqlite3.Error as e:
+        print(f"Error: could not save player state: {e}")
+
+@tasks.loop(seconds=LIBRARY_SCAN_INTERVAL)
+async def scan_library():
+    try:
+        changed, removed = await asyncio.to_thread(library.scan)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Error: could not scan the local library: {e}")
+        return
+    if changed or removed:
+        print(f'{EMOJIS["info"]} Local library: {changed} files indexed, {removed} removed, {library.count()} total')
+
+async def restore_players():
+    """Bring back the players saved before the last restart, all at once"""
+    rows = await asyncio.to_thread(state.load)
+    results = await asyncio.gather(*(restore_player(*row) for row in rows), return_exceptions=True)
+    restored = sum(1 for result in results if result is True)
+    if rows:
+        print(f'{EMOJIS["success"]} Restored {restored} of {len(rows)} saved players')
+
+async def restore_player(guild_id, voice_channel_id, text_channel_id, volume, loop, shuffle, paused,
+                         current, position, queue, history, saved):
+    guild = bot.get_guild(guild_id)
+    if guild is None:
+        return False  # on another shard, or the bot was removed
+    voice_channel = guild.get_channel(voice_channel_id) if voice_channel_id else None
+    text_channel = guild.get_channel(text_channel_id) if text_channel_id else None
+    current = json.loads(current) if current else None
+    # Only rejoin where someone is still listening
+    if (voice_channel is None or text_channel is None or not (current or queue)
+            or not any(not m.bot for m in voice_channel.members)):
+        state.forget(guild_id)
+        return False
+    
+    player = get_player(guild_id)
+    player.volume = volume
+    player.loop = bool(loop)
+    player.shuffle = bool(shuffle)
+    player.text_channel_id = text_channel_id
+    # Songs come back as they were saved, stream URLs are only re-resolved once they are needed
+    player.queue.rebuild(Song.from_snapshot(song) for song in queue)
+    player.history.extend(Song.from_snapshot(song) for song in history)
+    try:
+        player.voice_client = await voice_channel.connect()
+    except Exception as e:
+        print(f"Error: could not rejoin voice in {guild_id}: {e}")
+        return False
+    
+    ctx = ChannelContext(guild, text_channel)
+    if current:
+        await player.restore(ctx, Song.from_snapshot(current), max(0, position - RESTORE_REWIND), bool(paused))
+    else:
+        await player.play_next(ctx)
+    return True
+
+@tasks.loop(seconds=60)
+async def reap_idle_players():
+    now = time.monotonic()
+    for guild_id, player in list(music_players.items()):
+        if player.is_playing() or now - player.last_active < IDLE_TIMEOUT:
+            continue
         try:
-            source = await YTDLSource.from_url(song['url'], loop=self.bot.loop, stream=True)
-            source.volume = self.volume
-            self.current = source
-            self.voice_client.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(self.play_next(ctx), self.bot.loop))
-            
-            embed = discord.Embed(
-                title=f"{EMOJIS['music']} Now Playing",
-                description=f"**{source.title}**",
-                color=0x00ff00
-            )
-            if source.thumbnail:
-                embed.set_thumbnail(url=source.thumbnail)
-            if source.uploader:
-                embed.add_field(name=f"{EMOJIS['microphone']} Uploader", value=source.uploader, inline=True)
-            if source.duration:
-                mins, secs = divmod(source.duration, 60)
-                embed.add_field(name=f"{EMOJIS['info']} Duration", value=f"{int(mins):02d}:{int(secs):02d}", inline=True)
-            
-            await ctx.send(embed=embed)
-            
+            await player.shutdown()
         except Exception as e:
-            embed = discord.Embed(
-                title=f"{EMOJIS['error']} Error",
-                description=f"Could not play the song: {str(e)}",
-                color=0xff0000
-            )
-            await ctx.send(embed=embed)
-            await self.play_next(ctx)
+            print(f"Error: could not shut down idle player {guild_id}: {e}")
+        if music_players.get(guild_id) is player:
+            del music_players[guild_id]
+    messages.prune()
 
-# Global music players for each guild
-music_players = {}
+metrics.add_gauge('muse_players', 'Resident music players', lambda: len(music_players))
+metrics.add_gauge('muse_queue_length', 'Songs queued per guild', lambda: {guild_id: len(player.queue) for guild_id, player in music_players.items()}, label='guild')
+metrics.add_gauge('muse_ffmpeg_processes', 'Running FFmpeg processes, playback and cache fills',
+                  lambda: sum(1 for source in list(live_sources) if source.ffmpeg_running()) + len(audio_cache.filling) + len(broadcasts.stations))
+metrics.add_gauge('muse_broadcast_listeners', 'Guilds tuned in to each shared broadcast',
+                  lambda: {key: station.listeners for key, station in list(broadcasts.stations.items())}, label='station')
+metrics.add_gauge('muse_extract_queue_depth', 'Extraction jobs waiting for a worker', lambda: extractor.depth)
 
-def get_player(guild_id):
-    if guild_id not in music_players:
-        music_players[guild_id] = MusicPlayer(bot)
-    return music_players[guild_id]
+def process_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
 
 @bot.event
 async def on_ready():
     print(f'{EMOJIS["success"]} {bot.user} is now online!')
     print(f'{EMOJIS["info"]} Loaded in {len(bot.guilds)} servers')
     
-    # Sync slash commands
+    if not reap_idle_players.is_running():
+        reap_idle_players.start()
+    try:
+        await metrics.start(METRICS_PORT and METRICS_PORT + (SHARD_IDS[0] if SHARD_IDS else 0))
+    except OSError as e:
+        print(f'{EMOJIS["error"]} Failed to start metrics endpoint: {e}')
+    
+    # Start the extraction workers now so they are warm by the first /play
+    extractor.start()
+    
+    # Pick up playback from before the restart, once per process
+    if not state.restored:
+        state.restored = True
+        bot.loop.create_task(restore_players())
+    if not flush_state.is_running():
+        flush_state.start()
+    # Every worker reads the library index, but only the one with shard 0 writes it
+    shard_ids = getattr(bot, 'shard_ids', None)
+    if library.enabled and not (shard_ids and 0 not in shard_ids) and not scan_library.is_running():
+        scan_library.start()
+    
+    # Sync slash commands, once for the whole shard set and only once per process
+    global commands_synced
+    if commands_synced or (shard_ids and 0 not in shard_ids):
+        return
+    commands_synced = True
+    bot.loop.create_task(sync_commands())
+
+def command_tree_hash(guild=None):
+    """Fingerprint of the slash commands as Discord would receive them"""
+    payload = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands(guild=guild)), key=lambda command: command['name'])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+async def sync_commands():
+    """Sync slash commands, skipping the call when nothing changed since the last sync"""
+    guild = discord.Object(id=DEV_GUILD_ID) if DEV_GUILD_ID else None
+    if guild:
+        # Guild commands update instantly, handy while developing
+        bot.tree.copy_global_to(guild=guild)
+    target = f"{bot.application_id}:{DEV_GUILD_ID or 'global'}"
+    digest = command_tree_hash(guild)
+    
+    try:
+        with open(COMMAND_HASH_FILE) as f:
+            hashes = json.load(f)
+    except (OSError, ValueError):
+        hashes = {}
+    if hashes.get(target) == digest:
+        print(f'{EMOJIS["info"]} Slash commands unchanged, skipping sync')
+        return
+    
     try:
-        synced = await bot.tree.sync()
+        synced = await bot.tree.sync(guild=guild)
         print(f'{EMOJIS["success"]} Synced {len(synced)} slash commands')
     except Exception as e:
         print(f'{EMOJIS["error"]} Failed to sync commands: {e}')
+        return
+    hashes[target] = digest
+    try:
+        with open(COMMAND_HASH_FILE, 'w') as f:
+            json.dump(hashes, f)
+    except OSError as e:
+        print(f'{EMOJIS["error"]} Could not save command hash: {e}')
+
+@bot.event
+async def on_voice_state_update(member, before, after):
+    if member.id == bot.user.id:
+        # Kicked or disconnected by a moderator: leave it at that rather than
+        # treating the cut-off track as a dropout and rejoining
+        player = music_players.get(member.guild.id)
+        if (before.channel and after.channel is None and player and player.voice_client
+                and not player.reconnecting):
+            player.stopping = True
+            await player.shutdown()
+            if music_players.get(member.guild.id) is player:
+                del music_players[member.guild.id]
+        return
+    # Once the last listener leaves, stop waiting on lookups for that guild
+    voice_client = member.guild.voice_client
+    if not voice_client or before.channel != voice_client.channel or after.channel == before.channel:
+        return
+    if not any(not m.bot for m in voice_client.channel.members):
+        extractor.cancel_guild(member.guild.id)
 
 # MUSIC COMMANDS
 
@@ -192,62 +2571,241 @@ async def play(ctx, *, query):
     if not player.voice_client:
         player.voice_client = await ctx.author.voice.channel.connect()
     
-    embed = discord.Embed(
-        title=f"{EMOJIS['loading']} Searching...",
-        description=f"Looking for: **{query}**",
-        color=0xffff00
-    )
-    message = await ctx.send(embed=embed)
+    if not (player.is_playing() or player.is_paused()):
+        player.requested_at = time.monotonic()
     
-    try:
-        # Search for the song
-        loop = asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(f"ytsearch:{query}", download=False))
-        
-        if 'entries' in data and data['entries']:
-            song_data = data['entries'][0]
-            song_info = {
-                'url': song_data['url'],
-                'title': song_data['title'],
-                'duration': song_data.get('duration'),
-                'thumbnail': song_data.get('thumbnail'),
-                'uploader': song_data.get('uploader'),
-                'requester': ctx.author
-            }
-            
-            if player.is_playing() or player.queue:
-                await player.add_to_queue(song_info)
-                
+    # Typing (or a deferred slash response) stands in for a "Searching..." message
+    async with ctx.typing(ephemeral=True):
+        if PLAYLIST_RE.match(query):
+            try:
+                title, count = await player.add_playlist(ctx, query)
                 embed = discord.Embed(
-                    title=f"{EMOJIS['success']} Added to Queue",
-                    description=f"**{song_info['title']}**",
+                    title=f"{EMOJIS['success']} Playlist Added",
+                    description=f"Added **{count}** songs from **{title or 'playlist'}**",
                     color=0x00ff00
                 )
-                embed.add_field(name=f"{EMOJIS['queue']} Position", value=len(player.queue), inline=True)
-                if song_info['thumbnail']:
-                    embed.set_thumbnail(url=song_info['thumbnail'])
                 embed.set_footer(text=f"Requested by {ctx.author.display_name}")
-                
-                await message.edit(embed=embed)
-            else:
-                await player.add_to_queue(song_info)
-                await player.play_next(ctx)
-                await message.delete()
-        else:
+            except Exception as e:
+                embed = discord.Embed(
+                    title=f"{EMOJIS['error']} Error",
+                    description=f"An error occurred: {str(e)}",
+                    color=0xff0000
+                )
+            await ctx.send(embed=embed)
+            return
+        
+        try:
+            # Search for the song, reusing an earlier resolution when we have one. Only a
+            # song that starts right away needs its stream now, queued ones get it later
+            idle = not (player.is_playing() or player.queue)
+            song_data = await resolve_track(query, guild_id=ctx.guild.id, full=idle,
+                                            priority=PRIORITY_NOW if idle else PRIORITY_NORMAL)
+        except Exception as e:
             embed = discord.Embed(
                 title=f"{EMOJIS['error']} Error",
-                description="No songs found with that query!",
+                description=f"An error occurred: {str(e)}",
                 color=0xff0000
             )
-            await message.edit(embed=embed)
+            await ctx.send(embed=embed)
+            return
+    
+    if not song_data:
+        embed = discord.Embed(
+            title=f"{EMOJIS['error']} Error",
+            description="No songs found with that query!",
+            color=0xff0000
+        )
+        await ctx.send(embed=embed)
+        return
+    
+    song_info = Song.from_info(song_data, ctx.author)
+    search_index.add(song_data, query)
+    
+    if player.is_playing() or player.queue:
+        await player.add_to_queue(song_info)
+        # Bursts of additions share one notice in the channel
+        messages.queued(ctx.channel, song_info, len(player.queue))
+        embed = discord.Embed(
+            title=f"{EMOJIS['success']} Added to Queue",
+            description=f"**{song_info.title}**",
+            color=0x00ff00
+        )
+        embed.add_field(name=f"{EMOJIS['queue']} Position", value=len(player.queue), inline=True)
+    else:
+        await player.add_to_queue(song_info)
+        await player.play_next(ctx)
+        embed = discord.Embed(
+            title=f"{EMOJIS['music']} Now Playing",
+            description=f"**{song_info.title}**",
+            color=0x00ff00
+        )
+    if ctx.interaction:
+        # Slash commands still need an answer, only the requester sees it
+        await ctx.send(embed=embed, ephemeral=True)
+
+def playmany_embed(added, failed, total, done=False):
+    embed = discord.Embed(
+        title=f"{EMOJIS['success']} Songs Added" if done else f"{EMOJIS['loading']} Adding Songs...",
+        description=f"Added **{added}** of **{total}** songs",
+        color=0x00ff00 if done else 0xffff00
+    )
+    # Searches that found nothing apart from lookups that never finished, which may work if retried
+    not_found = [(query, None) for query, reason in failed if reason is None]
+    errors = [(query, reason) for query, reason in failed if reason is not None]
+    for name, entries in ((f"{EMOJIS['error']} Not Found", not_found), (f"{EMOJIS['warning']} Lookup Failed", errors)):
+        if not entries:
+            continue
+        # Shorter queries when a reason follows, fields hold 1024 characters
+        shown = '\n'.join(f"`{query[:50]}` ({reason[:40]})" if reason else f"`{query[:80]}`" for query, reason in entries[:10])
+        if len(entries) > 10:
+            shown += f"\n...and {len(entries) - 10} more"
+        embed.add_field(name=name, value=shown, inline=False)
+    return embed
+
+@bot.command(name='playmany', aliases=['pm'])
+async def playmany(ctx, *, queries):
+    """Queue several songs at once, separated by new lines or semicolons"""
+    if not ctx.author.voice:
+        embed = discord.Embed(
+            title=f"{EMOJIS['error']} Error",
+            description="You need to be in a voice channel!",
+            color=0xff0000
+        )
+        await ctx.send(embed=embed)
+        return
+    
+    queries = [query.strip() for query in PLAYMANY_SPLIT_RE.split(queries) if query.strip()][:PLAYMANY_LIMIT]
+    if not queries:
+        embed = discord.Embed(
+            title=f"{EMOJIS['error']} Error",
+            description="Give one song per line or separate them with `;`",
+            color=0xff0000
+        )
+        await ctx.send(embed=embed)
+        return
+    
+    player = get_player(ctx.guild.id)
+    
+    if not player.voice_client:
+        player.voice_client = await ctx.author.voice.channel.connect()
+    
+    if not (player.is_playing() or player.is_paused()):
+        player.requested_at = time.monotonic()
+    
+    message = await ctx.send(embed=playmany_embed(0, [], len(queries)))
+    
+    # Look everything up at once, a few at a time, but queue strictly in the order given
+    limit = asyncio.Semaphore(PLAYMANY_CONCURRENCY)
+    
+    async def lookup(query):
+        async with limit:
+            return await resolve_track(query, guild_id=ctx.guild.id, priority=PRIORITY_BULK)
+    
+    lookups = [asyncio.ensure_future(lookup(query)) for query in queries]
+    added, failed = 0, []
+    last_update = time.monotonic()
+    try:
+        for query, task in zip(queries, lookups):
+            # asyncio.wait leaves the lookup alone if this command is cancelled,
+            # so a cancelled lookup here means cancel_guild stopped it
+            await asyncio.wait((task,))
+            if task.cancelled():
+                failed.append((query, "cancelled"))
+                continue
+            try:
+                song_data = task.result()
+            except Exception as e:
+                print(f"playmany: {query}: {e}")
+                # Busy and timeout messages read fine up to the first comma
+                failed.append((query, str(e).split(',')[0] if isinstance(e, ExtractionError) else "lookup error"))
+                continue
+            if not song_data:
+                failed.append((query, None))
+                continue
             
-    except Exception as e:
+            search_index.add(song_data, query)
+            starting = not (player.is_playing() or player.queue)
+            await player.add_to_queue(Song.from_info(song_data, ctx.author))
+            added += 1
+            if starting:
+                # Resolving the first song can be cut short by cancel_guild just the same
+                starter = asyncio.ensure_future(player.play_next(ctx))
+                await asyncio.wait((starter,))
+                if not starter.cancelled():
+                    starter.result()
+            
+            if time.monotonic() - last_update >= PROGRESS_INTERVAL:
+                last_update = time.monotonic()
+                await message.edit(embed=playmany_embed(added, failed, len(queries)))
+    finally:
+        for task in lookups:
+            task.cancel()
+        # Whatever cut the run short, leave the final count rather than "Adding Songs..."
+        failed.extend((query, "cancelled") for query in queries[added + len(failed):])
+        await message.edit(embed=playmany_embed(added, failed, len(queries), done=True))
+
+@bot.command(name='radio')
+async def radio(ctx, *, url):
+    """Tune in to a shared broadcast of a stream or song"""
+    if not ctx.author.voice:
+        embed = discord.Embed(
+            title=f"{EMOJIS['error']} Error",
+            description="You need to be in a voice channel!",
+            color=0xff0000
+        )
+        await ctx.send(embed=embed)
+        return
+    
+    player = get_player(ctx.guild.id)
+    
+    if not player.voice_client:
+        player.voice_client = await ctx.author.voice.channel.connect()
+    
+    async with ctx.typing(ephemeral=True):
+        try:
+            song_data = await resolve_track(url, guild_id=ctx.guild.id, full=True, priority=PRIORITY_NOW)
+        except Exception as e:
+            embed = discord.Embed(
+                title=f"{EMOJIS['error']} Error",
+                description=f"An error occurred: {str(e)}",
+                color=0xff0000
+            )
+            await ctx.send(embed=embed)
+            return
+    
+    if not song_data:
         embed = discord.Embed(
             title=f"{EMOJIS['error']} Error",
-            description=f"An error occurred: {str(e)}",
+            description="No stream found with that query!",
             color=0xff0000
         )
-        await message.edit(embed=embed)
+        await ctx.send(embed=embed)
+        return
+    
+    # The broadcast replaces the queue, every guild tuned in hears the same audio
+    player.cancel_ingestion()
+    player.queue.clear()
+    player.cancel_prefetch()
+    player.cancel_refresh()
+    source = broadcasts.subscribe(song_data)
+    if player.is_playing() or player.is_paused():
+        player.swap(source)
+    else:
+        player.current = source
+        player.start(ctx, source)
+    
+    others = source.station.listeners - 1
+    embed = discord.Embed(
+        title=f"{EMOJIS['radio']} Radio",
+        description=f"**{source.title}**",
+        color=0x00ff00
+    )
+    if source.thumbnail:
+        embed.set_thumbnail(url=source.thumbnail)
+    if others:
+        embed.add_field(name=f"{EMOJIS['headphones']} Listening", value=f"with {others} other server{'s' if others != 1 else ''}", inline=True)
+    embed.set_footer(text="Volume changes don't apply to broadcasts")
+    await ctx.send(embed=embed)
 
 @bot.command(name='pause')
 async def pause(ctx):
@@ -257,6 +2815,7 @@ async def pause(ctx):
     if player.is_playing():
         player.voice_client.pause()
         player.paused = True
+        state.mark(player)
         embed = discord.Embed(
             title=f"{EMOJIS['pause']} Paused",
             description="Music has been paused",
@@ -279,6 +2838,7 @@ async def resume(ctx):
     if player.is_paused():
         player.voice_client.resume()
         player.paused = False
+        state.mark(player)
         embed = discord.Embed(
             title=f"{EMOJIS['play']} Resumed",
             description="Music has been resumed",
@@ -299,9 +2859,13 @@ async def stop(ctx):
     player = get_player(ctx.guild.id)
     
     if player.voice_client:
-        player.voice_client.stop()
+        player.cancel_ingestion()
         player.queue.clear()
+        player.cancel_prefetch()
+        player.cancel_refresh()
+        player.skip()
         player.current = None
+        state.mark(player)
         embed = discord.Embed(
             title=f"{EMOJIS['stop']} Stopped",
             description="Music stopped and queue cleared",
@@ -322,7 +2886,7 @@ async def skip(ctx):
     player = get_player(ctx.guild.id)
     
     if player.voice_client and player.voice_client.is_playing():
-        player.voice_client.stop()
+        player.skip()
         embed = discord.Embed(
             title=f"{EMOJIS['skip']} Skipped",
             description="Skipped to next song",
@@ -337,8 +2901,80 @@ async def skip(ctx):
         )
         await ctx.send(embed=embed)
 
+QUEUE_PAGE_SIZE = 10
+
+async def seek_to(ctx, position):
+    player = get_player(ctx.guild.id)
+    
+    if not (player.is_playing() or player.is_paused()) or not player.current:
+        embed = discord.Embed(
+            title=f"{EMOJIS['error']} Error",
+            description="Nothing is currently playing!",
+            color=0xff0000
+        )
+        await ctx.send(embed=embed)
+        return
+    
+    if isinstance(player.current, BroadcastReader):
+        embed = discord.Embed(
+            title=f"{EMOJIS['error']} Error",
+            description="Radio broadcasts play live and can't be seeked!",
+            color=0xff0000
+        )
+        await ctx.send(embed=embed)
+        return
+    
+    if is_live(player.current.data):
+        embed = discord.Embed(
+            title=f"{EMOJIS['error']} Error",
+            description="Live streams can't be seeked!",
+            color=0xff0000
+        )
+        await ctx.send(embed=embed)
+        return
+    
+    position = await player.seek(position)
+    description = f"Now at **{format_timestamp(position)}**"
+    if player.current.duration:
+        description += f" / {format_timestamp(player.current.duration)}"
+    embed = discord.Embed(
+        title=f"{EMOJIS['play']} Seeked",
+        description=description,
+        color=0x00ff00
+    )
+    await ctx.send(embed=embed)
+
+@bot.command(name='seek')
+async def seek(ctx, timestamp: str):
+    """Jump to a position in the current song (mm:ss)"""
+    try:
+        position = parse_timestamp(timestamp)
+    except ValueError:
+        embed = discord.Embed(
+            title=f"{EMOJIS['error']} Error",
+            description="Give the position as `mm:ss`, `hh:mm:ss` or seconds!",
+            color=0xff0000
+        )
+        await ctx.send(embed=embed)
+        return
+    await seek_to(ctx, position)
+
+@bot.command(name='forward', aliases=['ff'])
+async def forward(ctx, seconds: int = 10):
+    """Skip ahead in the current song"""
+    player = get_player(ctx.guild.id)
+    position = player.current.position if player.current else 0
+    await seek_to(ctx, position + seconds)
+
+@bot.command(name='rewind', aliases=['rw'])
+async def rewind(ctx, seconds: int = 10):
+    """Go back in the current song"""
+    player = get_player(ctx.guild.id)
+    position = player.current.position if player.current else 0
+    await seek_to(ctx, position - seconds)
+
 @bot.command(name='queue', aliases=['q'])
-async def queue(ctx):
+async def queue(ctx, page: int = 1):
     """Show the current queue"""
     player = get_player(ctx.guild.id)
     
@@ -351,6 +2987,9 @@ async def queue(ctx):
         await ctx.send(embed=embed)
         return
     
+    pages = max(1, -(-len(player.queue) // QUEUE_PAGE_SIZE))
+    page = max(1, min(page, pages))
+    
     embed = discord.Embed(
         title=f"{EMOJIS['queue']} Music Queue",
         color=0x3498db
@@ -365,8 +3004,9 @@ async def queue(ctx):
     
     if player.queue:
         queue_text = ""
-        for i, song in enumerate(list(player.queue)[:10], 1):
-            queue_text += f"`{i}.` **{song['title']}**\n"
+        start = (page - 1) * QUEUE_PAGE_SIZE
+        for i, song in enumerate(player.queue.page(page - 1, QUEUE_PAGE_SIZE), start + 1):
+            queue_text += f"`{i}.` **{song.title}**\n"
         
         embed.add_field(
             name=f"{EMOJIS['musical_note']} Up Next",
@@ -374,9 +3014,82 @@ async def queue(ctx):
             inline=False
         )
         
-        if len(player.queue) > 10:
-            embed.set_footer(text=f"And {len(player.queue) - 10} more songs...")
+        embed.set_footer(text=f"Page {page}/{pages} - {len(player.queue)} songs")
+    
+    await ctx.send(embed=embed)
+
+async def send_bad_position(ctx, player):
+    embed = discord.Embed(
+        title=f"{EMOJIS['error']} Error",
+        description=f"Pick a position between 1 and {len(player.queue)}!" if player.queue else "The queue is empty!",
+        color=0xff0000
+    )
+    await ctx.send(embed=embed)
+
+@bot.command(name='remove', aliases=['rm'])
+async def remove(ctx, position: int):
+    """Remove a song from the queue"""
+    player = get_player(ctx.guild.id)
+    
+    if not 1 <= position <= len(player.queue):
+        await send_bad_position(ctx, player)
+        return
+    
+    song = player.queue.pop(position - 1)
+    player.queue_changed()
+    
+    embed = discord.Embed(
+        title=f"{EMOJIS['success']} Removed",
+        description=f"Removed **{song.title}** from the queue",
+        color=0x00ff00
+    )
+    await ctx.send(embed=embed)
+
+@bot.command(name='move', aliases=['mv'])
+async def move(ctx, src: int, dst: int):
+    """Move a song to another position in the queue"""
+    player = get_player(ctx.guild.id)
+    
+    if not (1 <= src <= len(player.queue) and 1 <= dst <= len(player.queue)):
+        await send_bad_position(ctx, player)
+        return
+    
+    song = player.queue.move(src - 1, dst - 1)
+    player.queue_changed()
+    
+    embed = discord.Embed(
+        title=f"{EMOJIS['success']} Moved",
+        description=f"Moved **{song.title}** to position **{dst}**",
+        color=0x00ff00
+    )
+    await ctx.send(embed=embed)
+
+@bot.command(name='jump', aliases=['skipto'])
+async def jump(ctx, position: int):
+    """Skip ahead to a song in the queue"""
+    player = get_player(ctx.guild.id)
+    
+    if not 1 <= position <= len(player.queue):
+        await send_bad_position(ctx, player)
+        return
+    
+    if not (player.is_playing() or player.is_paused()):
+        embed = discord.Embed(
+            title=f"{EMOJIS['error']} Error",
+            description="Nothing is currently playing!",
+            color=0xff0000
+        )
+        await ctx.send(embed=embed)
+        return
+    
+    song = player.queue[position - 1]
+    player.jump(position - 1)
     
+    embed = discord.Embed(
+        title=f"{EMOJIS['skip']} Jumped",
+        description=f"Skipping to **{song.title}**",
+        color=0x00ff00
+    )
     await ctx.send(embed=embed)
 
 @bot.command(name='volume', aliases=['vol'])
@@ -402,9 +3115,7 @@ async def volume(ctx, volume: int = None):
         await ctx.send(embed=embed)
         return
     
-    player.volume = volume / 100
-    if player.voice_client and player.voice_client.source:
-        player.voice_client.source.volume = player.volume
+    await player.set_volume(volume / 100)
     
     if volume == 0:
         emoji = EMOJIS['volume_mute']
@@ -425,6 +3136,9 @@ async def loop(ctx):
     """Toggle loop mode"""
     player = get_player(ctx.guild.id)
     player.loop = not player.loop
+    state.mark(player)
+    if player.current:
+        player.schedule_prefetch()
     
     embed = discord.Embed(
         title=f"{EMOJIS['repeat']} Loop {'Enabled' if player.loop else 'Disabled'}",
@@ -438,6 +3152,9 @@ async def shuffle(ctx):
     """Toggle shuffle mode"""
     player = get_player(ctx.guild.id)
     player.shuffle = not player.shuffle
+    state.mark(player)
+    if player.current:
+        player.schedule_prefetch()
     
     embed = discord.Embed(
         title=f"{EMOJIS['shuffle']} Shuffle {'Enabled' if player.shuffle else 'Disabled'}",
@@ -452,10 +3169,7 @@ async def disconnect(ctx):
     player = get_player(ctx.guild.id)
     
     if player.voice_client:
-        await player.voice_client.disconnect()
-        player.voice_client = None
-        player.queue.clear()
-        player.current = None
+        await player.shutdown()
         
         embed = discord.Embed(
             title=f"{EMOJIS['success']} Disconnected",
@@ -501,6 +3215,7 @@ async def nowplaying(ctx):
         mins, secs = divmod(player.current.duration, 60)
         embed.add_field(name=f"{EMOJIS['info']} Duration", value=f"{int(mins):02d}:{int(secs):02d}", inline=True)
     
+    embed.add_field(name=f"{EMOJIS['play']} Position", value=format_timestamp(player.current.position), inline=True)
     embed.add_field(name=f"{EMOJIS['speaker']} Volume", value=f"{int(player.volume * 100)}%", inline=True)
     embed.add_field(name=f"{EMOJIS['repeat']} Loop", value="ON" if player.loop else "OFF", inline=True)
     embed.add_field(name=f"{EMOJIS['shuffle']} Shuffle", value="ON" if player.shuffle else "OFF", inline=True)
@@ -508,6 +3223,41 @@ async def nowplaying(ctx):
     
     await ctx.send(embed=embed)
 
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+@bot.command(name='stats')
+async def stats(ctx):
+    """Show resource usage"""
+    players = list(music_players.values())
+    queued = sum(len(player.queue) for player in players)
+    footprint = sum(player.footprint() for player in players)
+    connected = sum(1 for player in players if player.voice_client)
+    
+    embed = discord.Embed(
+        title=f"{EMOJIS['info']} Bot Stats",
+        color=0x3498db
+    )
+    embed.add_field(name=f"{EMOJIS['headphones']} Players", value=f"{len(players)} resident, {connected} in voice", inline=True)
+    embed.add_field(name=f"{EMOJIS['queue']} Queued", value=f"{queued} songs", inline=True)
+    embed.add_field(name=f"{EMOJIS['cd']} Player Memory", value=f"~{format_bytes(footprint)}", inline=True)
+    rss = process_rss()
+    if rss:
+        embed.add_field(name=f"{EMOJIS['info']} Process RSS", value=format_bytes(rss), inline=True)
+    embed.add_field(name=f"{EMOJIS['loading']} Lookups Waiting", value=str(extractor.depth), inline=True)
+    embed.add_field(name=f"{EMOJIS['radio']} Track Cache", value=f"{len(track_cache.tracks)} tracks", inline=True)
+    if library.enabled:
+        embed.add_field(name=f"{EMOJIS['cd']} Local Library", value=f"{library.count()} files", inline=True)
+    shard_ids = getattr(bot, 'shard_ids', None)
+    if shard_ids:
+        embed.add_field(name=f"{EMOJIS['cd']} Shards", value=f"{min(shard_ids)}-{max(shard_ids)} of {bot.shard_count}", inline=True)
+    
+    await ctx.send(embed=embed)
+
 # SLASH COMMANDS
 
 @bot.tree.command(name="play", description="Play a song or add to queue")
@@ -516,6 +3266,26 @@ async def slash_play(interaction: discord.Interaction, query: str):
     ctx = await bot.get_context(interaction)
     await play(ctx, query=query)
 
+@slash_play.autocomplete('query')
+async def slash_play_autocomplete(interaction: discord.Interaction, current: str):
+    # Picking a suggestion sends its URL, which the track cache resolves by video ID,
+    # or for files in the local library their local: ID
+    local = [app_commands.Choice(name=f"{EMOJIS['cd']} {data['title']}"[:100], value=data['id'])
+             for data in library.matches(current, limit=10)] if library.enabled else []
+    return local + [app_commands.Choice(name=title[:100], value=url) for url, title in search_index.suggest(current, limit=25 - len(local))]
+
+@bot.tree.command(name="playmany", description="Queue several songs at once, separated by semicolons")
+async def slash_playmany(interaction: discord.Interaction, queries: str):
+    """Slash command version of playmany"""
+    ctx = await bot.get_context(interaction)
+    await playmany(ctx, queries=queries)
+
+@bot.tree.command(name="radio", description="Tune in to a shared broadcast of a stream or song")
+async def slash_radio(interaction: discord.Interaction, url: str):
+    """Slash command version of radio"""
+    ctx = await bot.get_context(interaction)
+    await radio(ctx, url=url)
+
 @bot.tree.command(name="pause", description="Pause the current song")
 async def slash_pause(interaction: discord.Interaction):
     """Slash command version of pause"""
@@ -540,11 +3310,41 @@ async def slash_stop(interaction: discord.Interaction):
     ctx = await bot.get_context(interaction)
     await stop(ctx)
 
+@bot.tree.command(name="seek", description="Jump to a position in the current song (mm:ss)")
+async def slash_seek(interaction: discord.Interaction, timestamp: str):
+    """Slash command version of seek"""
+    ctx = await bot.get_context(interaction)
+    await seek(ctx, timestamp=timestamp)
+
+@bot.tree.command(name="forward", description="Skip ahead in the current song")
+async def slash_forward(interaction: discord.Interaction, seconds: int = 10):
+    """Slash command version of forward"""
+    ctx = await bot.get_context(interaction)
+    await forward(ctx, seconds=seconds)
+
+@bot.tree.command(name="rewind", description="Go back in the current song")
+async def slash_rewind(interaction: discord.Interaction, seconds: int = 10):
+    """Slash command version of rewind"""
+    ctx = await bot.get_context(interaction)
+    await rewind(ctx, seconds=seconds)
+
 @bot.tree.command(name="queue", description="Show the current queue")
-async def slash_queue(interaction: discord.Interaction):
+async def slash_queue(interaction: discord.Interaction, page: int = 1):
     """Slash command version of queue"""
     ctx = await bot.get_context(interaction)
-    await queue(ctx)
+    await queue(ctx, page=page)
+
+@bot.tree.command(name="remove", description="Remove a song from the queue")
+async def slash_remove(interaction: discord.Interaction, position: int):
+    """Slash command version of remove"""
+    ctx = await bot.get_context(interaction)
+    await remove(ctx, position=position)
+
+@bot.tree.command(name="move", description="Move a song to another position in the queue")
+async def slash_move(interaction: discord.Interaction, src: int, dst: int):
+    """Slash command version of move"""
+    ctx = await bot.get_context(interaction)
+    await move(ctx, src=src, dst=dst)
 
 @bot.tree.command(name="volume", description="Change volume (0-100)")
 async def slash_volume(interaction: discord.Interaction, volume: int):
@@ -571,19 +3371,27 @@ async def music_help(ctx):
     
     playback_cmds = f"""
     `play <song/url/playlist>` - Play song, URL, or playlist
+    `playmany <a; b; c>` - Queue several songs at once
+    `radio <url>` - Tune in to a broadcast shared across servers
     `pause` - Pause current song
     `resume` - Resume paused song
     `stop` - Stop music and clear queue
     `skip` - Skip to next song
+    `seek <mm:ss>` - Jump to a position in the song
+    `forward [s]` / `rewind [s]` - Move 10 (or s) seconds
     `disconnect` - Leave voice channel
     """
     
     queue_cmds = f"""
-    `queue` - Show current queue
+    `queue [page]` - Show current queue
+    `remove <n>` - Remove song n from the queue
+    `move <from> <to>` - Move a song within the queue
+    `jump <n>` - Skip ahead to song n
     `nowplaying` - Show current song info
     `loop` - Toggle loop mode
     `shuffle` - Toggle shuffle mode
     `volume <0-100>` - Change volume
+    `stats` - Show bot resource usage
     """
     
     embed.add_field(name=f"{EMOJIS['play']} Playback", value=playback_cmds, inline=False)
@@ -613,5 +3421,79 @@ async def on_command_error(ctx, error):
         await ctx.send(embed=embed)
         print(f"Error: {error}")
 
+# Shard supervisor
+
+def recommended_shards(token):
+    request = urllib.request.Request('https://discord.com/api/v10/gateway/bot', headers={
+        'Authorization': f'Bot {token}',
+        'User-Agent': 'DiscordBot (https://github.com/Rapptz/discord.py, 2)'
+    })
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)['shards']
+
+def shard_ranges(total, workers):
+    workers = min(workers, total)
+    size, extra = divmod(total, workers)
+    ranges, start = [], 0
+    for i in range(workers):
+        end = start + size + (i < extra)
+        ranges.append(range(start, end))
+        start = end
+    return ranges
+
+def supervise(token, workers):
+    """Run one worker process per shard range and restart any that die"""
+    total = SHARD_COUNT or max(recommended_shards(token), workers)
+    ranges = shard_ranges(total, workers)
+    processes = [None] * len(ranges)
+    started = [0.0] * len(ranges)
+    backoff = [1] * len(ranges)
+    stopping = False
+
+    def spawn(i):
+        env = dict(os.environ, SHARD_COUNT=str(total), SHARD_IDS=','.join(map(str, ranges[i])))
+        processes[i] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        started[i] = time.monotonic()
+        print(f'{EMOJIS["info"]} Started shards {ranges[i].start}-{ranges[i].stop - 1} of {total} (pid {processes[i].pid})')
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes:
+            if process and process.poll() is None:
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for i in range(len(ranges)):
+        spawn(i)
+    restart_at = [None] * len(ranges)
+    while not stopping:
+        time.sleep(1)
+        now = time.monotonic()
+        for i, process in enumerate(processes):
+            if stopping:
+                break
+            if restart_at[i] is not None:
+                if now >= restart_at[i]:
+                    restart_at[i] = None
+                    spawn(i)
+            elif process.poll() is not None:
+                # Back off on workers that crash straight after starting
+                backoff[i] = 1 if now - started[i] > 60 else min(backoff[i] * 2, 60)
+                restart_at[i] = now + backoff[i]
+                print(f'{EMOJIS["error"]} Shard worker {i} exited with {process.returncode}, restarting in {backoff[i]}s')
+    for process in processes:
+        process.wait()
+
+def main():
+    token = os.getenv('DISCORD_TOKEN')
+    if SHARD_WORKERS > 1 and SHARD_IDS is None:
+        supervise(token, SHARD_WORKERS)
+    else:
+        bot.run(token)
+
 # Run the bot
-bot.run(os.getenv('DISCORD_TOKEN'))
+if __name__ == '__main__':
+    main()